@@ -1,12 +1,46 @@
 import sys
 import argparse
-from helpers import new_token, update_trivia_categories, next_category, level_counts, process_category
+import metrics
+from export import export_snapshot, snapshot_path
+from helpers import new_token, update_trivia_categories, verify_database, local_counts, known_fingerprints, session_token, stored_token, sync_plan, plan_estimate, process_plan, refresh_question_sequence, set_worker, throttle_report, failed_levels
 
 def main():
     parser = argparse.ArgumentParser(description="-t Use existing token if available - API will not return questions already provided within the last 6 hours")
     parser.add_argument('-t', action='store_true')
+    parser.add_argument('--plan', '--dry-run', dest='plan', action='store_true', help='print the requests a sync would make, without making them or changing the database')
+    parser.add_argument('--verify', action='store_true', help='compare the database with Open Trivia\'s counts and repair questions with missing or extra answers, without fetching questions')
+    parser.add_argument('--refresh', action='store_true', help='fetch every question, not just new ones, and update any corrected upstream - use without -t')
+    parser.add_argument('--worker', help='name for this worker when several share the database - each named worker keeps its own session token')
+    parser.add_argument('--report', help='file to save a JSON report of the run to')
+    parser.add_argument('--prometheus', help='file to save run metrics to in Prometheus textfile format')
     args = parser.parse_args()
 
+    if args.worker:
+        set_worker(args.worker)
+
+    try:
+        if args.plan:
+            show_plan(args)
+        elif args.verify:
+            verify(args)
+        else:
+            synchronise(args)
+    finally:
+        # Report on failed runs too - they're the ones worth looking into
+        if args.report:
+            metrics.write_report(args.report)
+
+        if args.prometheus:
+            metrics.write_prometheus(args.prometheus)
+
+
+def synchronise(args):
+
+    """ Add all outstanding Open Trivia questions to the local database
+
+        :param args: Parsed command line arguments
+    """
+
     if not args.t:
         # get new token to ensure api returns unique questions (going forward - they're only unique to the new token)
         new_token()
@@ -14,36 +48,101 @@ def main():
     # Make sure we're in sync with Open Trivia
     update_trivia_categories()
 
-    # Start with the next incomplete category
-    category = next_category()
+    # Count and fingerprint the questions we already have once - both are kept up to date as questions are added
+    local_counts()
+    known_fingerprints()
 
-    while category:
+    # Work out everything that's missing up front - levels an interrupted run left part way through pick up where they stopped
+    plan = sync_plan(session_token(), args.refresh)
 
-        category_id = category['id']
+    if not plan:
+        print("No new questions available")
 
-        # Get number of questions already processed for each difficulty level
-        already_done = level_counts(category_id)
+    # Categories are leased one at a time, so other workers can take the rest of the plan
+    process_plan(plan, args.refresh)
 
-        to_do_list = {
-            'category': category_id,
-            'total': category['total_question_count'],
-            'levels': {}
-        }
+    # Index the new questions for random selection by the API
+    indexed = refresh_question_sequence()
 
-        for level, done in already_done.items():
-            # Check for incomplete difficulty levels
-            available_questions = category[f"total_{level}_question_count"]
+    if indexed:
+        print(f"Indexed {indexed} new questions for random selection")
 
-            if done < available_questions:
-                # There are more questions to process for this level - place in to_do_list
-                to_do_list['levels'][level] = available_questions
-        
-        process_category(to_do_list)
+    if snapshot_path():
+        # Only questions changed since the last snapshot are read from the database
+        if export_snapshot(snapshot_path()) is None:
+            print(f"WARNING: unable to update the snapshot at {snapshot_path()}")
 
-        category = next_category(category_id + 1)
+    waits = throttle_report()
+    print(f"Spent {waits['throttled']:.1f}s throttled by the rate limit and {waits['backed_off']:.1f}s backing off over {waits['retries']} retries")
+
+    if failed_levels:
+        # A token won't return the questions of a page that couldn't be saved again, so don't suggest reusing it
+        print(f"\nERROR: {len(failed_levels)} levels couldn't be fetched or saved - run the programme again to fetch the rest of them")
+        sys.exit(1)
 
     print("SUCCESS: all questions have been processed :)")
     sys.exit(0)
 
+
+def show_plan(args):
+
+    """ Print the requests a sync would make, largest gap first
+
+        :param args: Parsed command line arguments
+    """
+
+    update_trivia_categories()
+
+    # Without -t the sync would get a new token, so progress made with the stored one doesn't count
+    plan = sync_plan(stored_token() if args.t else None, args.refresh)
+    estimate = plan_estimate(plan)
+
+    for step in plan:
+        note = f" (resuming - token can return {step['budget']} more)" if step['resuming'] else ""
+        if args.refresh:
+            print(f"Category {step['category']} ({step['level']}): refreshing {step['budget']} questions{note}")
+        else:
+            print(f"Category {step['category']} ({step['level']}): {step['gap']} of {step['available']} questions missing{note}")
+
+    print(f"\n{len(plan)} levels to synchronise: at least {estimate['requests']} question requests, taking about {estimate['seconds']:.0f}s at the configured rate")
+    sys.exit(0)
+
+
+def verify(args):
+
+    """ Reconcile the database with Open Trivia and print what was found and repaired
+
+        :param args: Parsed command line arguments
+    """
+
+    update_trivia_categories()
+
+    findings = verify_database()
+
+    if findings is None:
+        print("Unable to verify the database")
+        sys.exit(1)
+
+    if findings['missing_categories']:
+        print(f"Added {len(findings['missing_categories'])} missing categories: {', '.join(str(category_id) for category_id in findings['missing_categories'])}")
+
+    if findings['unknown_categories']:
+        print(f"WARNING: questions belong to categories Open Trivia no longer lists: {', '.join(str(category_id) for category_id in findings['unknown_categories'])}")
+
+    if findings['unanswered'] or findings['misanswered']:
+        print(f"Removed {findings['unanswered']} questions with no answers and {findings['misanswered']} with the wrong number of answers")
+
+    for entry in findings['drift']:
+        levels = ", ".join(f"{level} {count}" for level, count in sorted(entry['levels'].items()))
+        print(f"Category {entry['category']}: {entry['local']} questions stored ({levels or 'none'}), Open Trivia has {entry['upstream']}")
+
+    if findings['drift']:
+        print(f"\n{len(findings['drift'])} categories differ from Open Trivia - run the programme without -t to synchronise them, as questions already returned to the current token won't be returned again")
+    else:
+        print("All categories match Open Trivia")
+
+    sys.exit(0)
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import configparser
+from datetime import datetime, timezone
+from storage import create_backend
+from fakeopentdb import FakeOpenTDBServer, TriviaDataset
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def question_count(backend):
+
+    """ :return: Number of questions in the benchmark database
+    """
+
+    with backend.connection() as connection:
+        with backend.cursor(connection) as cursor:
+            cursor.execute("SELECT COUNT(*) FROM questions")
+            return cursor.fetchone()[0]
+
+
+def db_round_trips(report_path):
+
+    """ Get the number of calls the synchroniser made to the database, from its run report
+
+        :param report_path: Path of the JSON report written by app.py --report
+        :return: Round trip count, or None if the sync didn't write a report
+    """
+
+    if not os.path.exists(report_path):
+        return
+
+    with open(report_path) as report_file:
+        report = json.load(report_file)
+
+    return sum(counter['value'] for counter in report['counters'] if counter['name'] == 'db_round_trips_total')
+
+
+def run_sync(name, app_args, work_dir, server, backend):
+
+    """ Run the synchroniser against the stand-in API and measure it
+
+        :param name: Label for the run
+        :param app_args: Command line arguments for app.py
+        :param work_dir: Directory holding the benchmark appconfig.ini
+        :param server: The running FakeOpenTDBServer
+        :param backend: Storage backend for the benchmark database
+        :return: dict of measurements
+    """
+
+    with server.stats_lock:
+        api_before = dict(server.stats)
+
+    questions_before = question_count(backend)
+    report_path = os.path.join(work_dir, f"{name}-report.json")
+    started = time.perf_counter()
+
+    completed = subprocess.run([sys.executable, os.path.join(APP_DIR, 'app.py'), '--report', report_path] + app_args, cwd=work_dir, capture_output=True, text=True)
+
+    seconds = time.perf_counter() - started
+
+    questions_added = question_count(backend) - questions_before
+
+    with server.stats_lock:
+        api_calls = {endpoint: count - api_before.get(endpoint, 0) for endpoint, count in server.stats.items() if count != api_before.get(endpoint, 0)}
+
+    if completed.returncode != 0:
+        print(f"\nWARNING: {name} sync exited with code {completed.returncode}\n{completed.stdout[-2000:]}{completed.stderr[-2000:]}")
+
+    return {
+        'name': name,
+        'exit_code': completed.returncode,
+        'seconds': round(seconds, 3),
+        'questions_added': questions_added,
+        'questions_per_second': round(questions_added / seconds, 2) if seconds else 0,
+        'api_calls': sum(api_calls.values()),
+        'api_calls_by_endpoint': api_calls,
+        'db_round_trips': db_round_trips(report_path)
+    }
+
+
+def git_commit():
+
+    """ :return: Short hash of the checked out commit, or 'unknown'
+    """
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def previous_result(results_dir, settings):
+
+    """ Find the most recent saved result with the same settings
+
+        :param results_dir: Directory of saved results
+        :param settings: Settings of the current run
+        :return: dict of saved results or None
+    """
+
+    if not os.path.isdir(results_dir):
+        return
+
+    for filename in sorted(os.listdir(results_dir), reverse=True):
+        if not filename.endswith('.json'):
+            continue
+
+        with open(os.path.join(results_dir, filename)) as results_file:
+            saved = json.load(results_file)
+
+        if saved.get('settings') == settings:
+            return saved
+
+
+def print_report(result, previous):
+
+    """ Print the measurements for each run alongside the previous result, if any
+    """
+
+    print(f"\nBenchmark at commit {result['commit']}" + (f" (compared with {previous['commit']})" if previous else ""))
+
+    previous_runs = {run['name']: run for run in previous['runs']} if previous else {}
+
+    for run in result['runs']:
+        print(f"\n{run['name']} sync:")
+
+        for measure in ['seconds', 'questions_added', 'questions_per_second', 'api_calls', 'db_round_trips']:
+            line = f"  {measure}: {run[measure]}"
+
+            if run['name'] in previous_runs:
+                line += f" (was {previous_runs[run['name']][measure]})"
+
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure full and incremental syncs against a local stand-in for the Open Trivia API')
+    parser.add_argument('-c', '--config', help='config file containing MySQL credentials', default='appconfig.ini')
+    parser.add_argument('-b', '--backend', help='storage backend to benchmark', choices=['mysql', 'sqlite'], default='mysql')
+    parser.add_argument('-d', '--database', help='database to sync into - dropped and recreated for each benchmark', default='opentriviata_benchmark')
+    parser.add_argument('--categories', help='number of categories to serve', type=int, default=5)
+    parser.add_argument('--questions', help='number of questions per category for the full sync', type=int, default=200)
+    parser.add_argument('--grow', help='number of questions added to each category before the incremental sync', type=int, default=20)
+    parser.add_argument('--latency', help='seconds the stand-in API waits before answering each request', type=float, default=0.05)
+    parser.add_argument('--results', help='directory to save results in', default=os.path.join(APP_DIR, 'bench_results'))
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    if args.backend == 'mysql' and not 'dbconfig' in config:
+        print("Unable to access database credentials.")
+        sys.exit(1)
+
+    if args.database == 'opentriviata':
+        print("Refusing to benchmark against the opentriviata database - choose another name with -d")
+        sys.exit(1)
+
+    dbconfig = dict(config['dbconfig']) if 'dbconfig' in config else {}
+    settings = {
+        'backend': args.backend,
+        'categories': args.categories,
+        'questions': args.questions,
+        'grow': args.grow,
+        'latency': args.latency
+    }
+
+    server = FakeOpenTDBServer(('127.0.0.1', 0), TriviaDataset(args.categories, args.questions), args.latency).start()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        bench_config = configparser.ConfigParser()
+        bench_config['dbconfig'] = dbconfig
+        bench_config['dbconfig']['backend'] = args.backend
+        bench_config['dbconfig']['database'] = args.database
+        # SQLite databases live in the temporary directory
+        bench_config['dbconfig']['path'] = os.path.join(work_dir, f"{args.database}.sqlite3")
+        bench_config['apiconfig'] = {
+            'base_url': server.base_url,
+            # The stand-in API has no rate limit
+            'rate': "0"
+        }
+        bench_config['tokenconfig'] = {
+            'api_token': ""
+        }
+
+        with open(os.path.join(work_dir, 'appconfig.ini'), 'w') as configfile:
+            bench_config.write(configfile)
+
+        backend = create_backend(bench_config)
+
+        try:
+            backend.drop_database()
+        except backend.errors as e:
+            print(e)
+            sys.exit(1)
+
+        subprocess.run([sys.executable, os.path.join(APP_DIR, 'createdb.py'), '-c', 'appconfig.ini'], cwd=work_dir, check=True, capture_output=True)
+
+        runs = [run_sync('full', [], work_dir, server, backend)]
+
+        server.dataset.add_questions(args.grow)
+        runs.append(run_sync('incremental', ['-t'], work_dir, server, backend))
+
+        # Release the SQLite file before the temporary directory is removed
+        backend.drop_database()
+
+    server.shutdown()
+
+    result = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'settings': settings,
+        'runs': runs
+    }
+
+    previous = previous_result(args.results, settings)
+    print_report(result, previous)
+
+    os.makedirs(args.results, exist_ok=True)
+    results_path = os.path.join(args.results, f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}-{result['commit']}.json")
+
+    with open(results_path, 'w') as results_file:
+        json.dump(result, results_file, indent=2)
+
+    print(f"\nResults saved to {results_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from storage import tsv_field, fill_documents
+from records import decode_page
+from helpers import trivia_categories, new_token, update_trivia_categories, question_breakdown, fetch_pages, run_pipeline, failed_levels, known_fingerprints, record_changes, refresh_question_sequence, storage_backend
+
+
+def capture(directory):
+
+    """ Stream every page of questions the API returns to append-only JSONL files, one per category
+
+        :param directory: Directory to write the capture files to
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    update_trivia_categories()
+
+    for category_id in sorted(trivia_categories):
+        category = question_breakdown(category_id)['category']
+        capture_path = os.path.join(directory, f"category_{category_id}.jsonl")
+
+        print(f"\nCategory {category_id}: capturing {category['total_question_count']} questions to {capture_path}\n")
+
+        with open(capture_path, 'a') as capture_file:
+            def write_page(questions, req_details):
+                if not questions:
+                    # No more questions for this level
+                    return
+
+                capture_file.write(json.dumps({
+                    'category': category_id,
+                    'difficulty': req_details['parameters'].get('difficulty', "all"),
+                    'encoding': req_details['parameters'].get('encode', "default"),
+                    'fetched': time.time(),
+                    'results': questions
+                }) + "\n")
+
+                # Flush each page so an interrupted capture keeps everything fetched so far
+                capture_file.flush()
+
+            # Keep the raw question dictionaries so the capture is exactly what the API returned
+            run_pipeline(lambda: fetch_pages(category_id, [{'level': "all", 'count': category['total_question_count']}], decode=False), write_page)
+
+
+def write_load_files(directory, work_dir):
+
+    """ Convert captured pages into tab separated files for LOAD DATA, dropping questions already in the database
+
+        :param directory: Directory of capture files
+        :param work_dir: Directory to write the load files to
+        :return: dict with the paths of the load files, the categories seen and the number of questions staged
+    """
+
+    known = known_fingerprints()
+    staged = set()
+    categories = {}
+    questions_path = os.path.join(work_dir, 'questions.tsv')
+    answers_path = os.path.join(work_dir, 'answers.tsv')
+
+    with open(questions_path, 'w', encoding='utf-8', newline='') as questions_file, open(answers_path, 'w', encoding='utf-8', newline='') as answers_file:
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith('.jsonl'):
+                continue
+
+            with open(os.path.join(directory, filename), encoding='utf-8') as capture_file:
+                for line in capture_file:
+                    if not line.strip():
+                        continue
+
+                    page = json.loads(line)
+                    category_id = page['category']
+
+                    # Pages captured before the encoding was recorded used the API's default HTML entities
+                    for question in decode_page(category_id, page['results'], page.get('encoding', "default")):
+                        if question.fingerprint in known or question.fingerprint in staged:
+                            continue
+
+                        staged.add(question.fingerprint)
+                        categories[category_id] = question.category
+                        question_hash = question.fingerprint.hex()
+
+                        # Fingerprints are written as hex and converted back when loaded
+                        questions_file.write("\t".join(tsv_field(value) for value in question.question_row()[:5] + (question_hash, question.content_hash.hex())) + "\n")
+
+                        for row in question.answer_rows(question_hash):
+                            answers_file.write("\t".join(tsv_field(value) for value in row) + "\n")
+
+    return {
+        'questions': questions_path,
+        'answers': answers_path,
+        'categories': categories,
+        'staged': len(staged)
+    }
+
+
+def load(directory):
+
+    """ Bulk load captured questions and answers into the database in a single transaction
+
+        :param directory: Directory of capture files
+    """
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        load_files = write_load_files(directory, work_dir)
+
+        if not load_files['staged']:
+            print("No new questions to load")
+            return
+
+        db = storage_backend()
+
+        try:
+            with db.loader_connection() as connection:
+                with db.cursor(connection) as cursor:
+                    cursor.executemany(db.insert_ignore_sql('categories', ['id', 'category']), list(load_files['categories'].items()))
+
+                    cursor.execute("CREATE TEMPORARY TABLE staged_questions (category_id INTEGER NOT NULL, type VARCHAR(16) NOT NULL, difficulty VARCHAR(16) NOT NULL, question_text VARCHAR(768) NOT NULL, question_html TEXT NOT NULL, question_hash BINARY(16) NOT NULL PRIMARY KEY, content_hash BINARY(16) NOT NULL)")
+                    cursor.execute("CREATE TEMPORARY TABLE staged_answers (question_hash BINARY(16) NOT NULL, answer VARCHAR(768), answer_html TEXT, correct BOOLEAN NOT NULL)")
+
+                    question_columns = ['category_id', 'type', 'difficulty', 'question_text', 'question_html', 'question_hash', 'content_hash']
+                    db.bulk_load(cursor, 'staged_questions', question_columns, load_files['questions'], ['question_hash', 'content_hash'])
+                    db.bulk_load(cursor, 'staged_answers', ['question_hash', 'answer', 'answer_html', 'correct'], load_files['answers'], ['question_hash'])
+
+                    # Questions stored by another run since the fingerprints were read already have their answers
+                    cursor.execute("DELETE FROM staged_questions WHERE question_hash IN (SELECT question_hash FROM questions WHERE question_hash IS NOT NULL)")
+
+                    cursor.execute(db.insert_select_ignore_sql('questions', question_columns, f"SELECT {', '.join(question_columns)} FROM staged_questions WHERE true"))
+                    questions_added = cursor.rowcount
+
+                    # Questions skipped as duplicates of stored text have no row with their fingerprint, so get no answers
+                    cursor.execute("INSERT INTO answers (question_id, answer, answer_html, correct) SELECT questions.id, staged_answers.answer, staged_answers.answer_html, staged_answers.correct FROM staged_answers JOIN staged_questions ON staged_questions.question_hash = staged_answers.question_hash JOIN questions ON questions.question_hash = staged_answers.question_hash")
+                    answers_added = cursor.rowcount
+
+                    cursor.execute("SELECT questions.id, questions.category_id, questions.difficulty FROM questions JOIN staged_questions ON staged_questions.question_hash = questions.question_hash ORDER BY questions.id")
+                    changes = [row + ('insert',) for row in cursor.fetchall()]
+
+                    if changes:
+                        record_changes(cursor, changes)
+
+                    fill_documents(cursor)
+
+                    cursor.execute("DROP TABLE staged_questions")
+                    cursor.execute("DROP TABLE staged_answers")
+
+                connection.commit()
+
+        except db.errors as e:
+            print(e)
+            sys.exit(1)
+
+    print(f"Loaded {questions_added} questions and {answers_added} answers from {directory}")
+
+    # Index the new questions for random selection by the API
+    refresh_question_sequence()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Capture raw Open Trivia API pages to JSONL files, or bulk load captured pages into the database')
+    parser.add_argument('stage', choices=['fetch', 'load'], help='fetch: capture pages from the API, load: load captured pages into the database')
+    parser.add_argument('-d', '--directory', help='directory of capture files', default='captures')
+    parser.add_argument('-t', action='store_true', help='use existing token if available')
+    args = parser.parse_args()
+
+    if args.stage == 'fetch':
+        if not args.t:
+            # New token so the capture includes every question
+            new_token()
+
+        capture(args.directory)
+
+        if failed_levels:
+            levels = ", ".join(f"{category_id} ({level})" for category_id, level in failed_levels)
+            print(f"\nERROR: requests failed for {len(failed_levels)} levels - {levels} - run the capture again to fetch the rest of them")
+            sys.exit(1)
+    else:
+        load(args.directory)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import sys
+import json
+import argparse
+from helpers import db_transaction, fetch_all
+
+DEFAULT_LIMIT = 1000
+
+
+def changes_since(change_id, limit = DEFAULT_LIMIT):
+
+    """ Get the changes made after the given point in the feed
+
+        Pass the change_id of the last change returned to get the next batch - 0 starts from the beginning
+
+        :param change_id: Last change already seen
+        :param limit: Most changes to return
+        :return: List of change dictionaries in the order they were made, or None if the query failed
+    """
+
+    rows = db_transaction(lambda cursor: fetch_all(cursor, f"SELECT change_id, question_id, category_id, difficulty, change_type, changed_at FROM question_changes WHERE change_id > %s ORDER BY change_id LIMIT {int(limit)}", (change_id,)))
+
+    if rows is None:
+        return
+
+    return [
+        {
+            'change_id': change_id,
+            'question_id': question_id,
+            'category_id': category_id,
+            'difficulty': difficulty,
+            'change_type': change_type,
+            'changed_at': str(changed_at)
+        }
+        for change_id, question_id, category_id, difficulty, change_type, changed_at in rows
+    ]
+
+
+def latest_change():
+
+    """ :return: change_id of the most recent change, eg to start following the feed from now, or None if the query failed
+    """
+
+    rows = db_transaction(lambda cursor: fetch_all(cursor, "SELECT last_change_id FROM changefeed_head WHERE id = 1"))
+
+    if rows is None:
+        return
+
+    return rows[0][0] if rows else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print question changes made after the given change id as JSON lines')
+    parser.add_argument('-s', '--since', help='change_id of the last change already seen', type=int, default=0)
+    parser.add_argument('-l', '--limit', help='most changes to print', type=int, default=DEFAULT_LIMIT)
+    parser.add_argument('--latest', action='store_true', help='print the change_id of the most recent change and exit')
+    args = parser.parse_args()
+
+    if args.latest:
+        print(latest_change())
+        sys.exit(0)
+
+    changes = changes_since(args.since, args.limit)
+
+    if changes is None:
+        sys.exit(1)
+
+    for change in changes:
+        print(json.dumps(change))
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
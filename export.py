@@ -0,0 +1,142 @@
+import os
+import sys
+import argparse
+from helpers import config, db_transaction, fetch_all
+from snapshot import Snapshot, SnapshotError, write_snapshot, categories_fingerprint
+
+DEFAULT_SNAPSHOT_PATH = "opentriviata.snapshot"
+
+# Most ids in each IN (...) when reading changed questions
+ID_BATCH_SIZE = 500
+
+
+def snapshot_path():
+
+    """ :return: Snapshot file set in the [snapshotconfig] section of appconfig.ini, or None to skip exporting after a sync
+    """
+
+    return config.get('snapshotconfig', 'path', fallback=None)
+
+
+def previous_snapshot(path):
+
+    """ Read the questions from an existing snapshot so only changes need to be read from the database
+
+        :param path: Snapshot file
+        :return: dict with the last change id it includes, the identifier of the database it was taken from, the
+            fingerprint of its categories and its questions in the form write_snapshot() takes, or None if there's no
+            snapshot this version can read
+    """
+
+    if not os.path.exists(path):
+        return
+
+    try:
+        with Snapshot(path) as snapshot:
+            questions = {}
+
+            for row in range(snapshot.question_count):
+                question_id, category_id, difficulty, question_type, document, document_html = snapshot.question(row)
+                questions[question_id] = (category_id, difficulty, question_type, bytes(document), bytes(document_html))
+                document.release()
+                document_html.release()
+
+            return {
+                'last_change_id': snapshot.last_change_id,
+                'database_id': snapshot.database_id,
+                'categories_hash': snapshot.categories_hash,
+                'questions': questions
+            }
+
+    except SnapshotError as e:
+        print(f"{e} - exporting every question")
+
+
+def export_snapshot(path, full = False):
+
+    """ Export the synchronised questions to a snapshot file for serving nodes to read with snapshot.Snapshot
+
+        If an earlier snapshot of the same database exists, only questions in the change feed since it was written are
+        read from the database
+
+        :param path: Snapshot file to write
+        :param full: Read every question from the database, even if an earlier snapshot exists
+        :return: Number of questions read from the database, or None if the export failed
+    """
+
+    previous = None if full else previous_snapshot(path)
+
+    def read(cursor):
+        database_id = bytes(fetch_all(cursor, "SELECT identifier FROM database_identity WHERE id = 1")[0][0])
+        last_change_id = fetch_all(cursor, "SELECT last_change_id FROM changefeed_head WHERE id = 1")[0][0]
+
+        # Categories aren't in the change feed, so they're compared by fingerprint
+        categories = dict(fetch_all(cursor, "SELECT id, category FROM categories"))
+        same_database = previous is not None and previous['database_id'] == database_id and previous['last_change_id'] <= last_change_id
+
+        if same_database and previous['last_change_id'] == last_change_id and previous['categories_hash'] == categories_fingerprint(categories):
+            # Nothing has changed since the last export
+            return ()
+
+        select_questions = "SELECT id, category_id, difficulty, type, document, document_html FROM questions WHERE document IS NOT NULL"
+
+        if not same_database:
+            # No snapshot to build on, or it was taken from another database
+            questions = {}
+            rows = fetch_all(cursor, select_questions)
+            changed = []
+        else:
+            questions = previous['questions']
+            changed = [row[0] for row in fetch_all(cursor, "SELECT DISTINCT question_id FROM question_changes WHERE change_id > %s", (previous['last_change_id'],))]
+            rows = []
+
+            for start in range(0, len(changed), ID_BATCH_SIZE):
+                batch = changed[start:start + ID_BATCH_SIZE]
+                rows.extend(fetch_all(cursor, f"{select_questions} AND id IN ({', '.join(['%s'] * len(batch))})", batch))
+
+        for question_id in changed:
+            # Questions deleted since the last export have no row
+            questions.pop(question_id, None)
+
+        for question_id, category_id, difficulty, question_type, document, document_html in rows:
+            questions[question_id] = (category_id, difficulty, question_type, document.encode('utf-8'), document_html.encode('utf-8'))
+
+        return categories, questions, last_change_id, database_id, len(rows)
+
+    exported = db_transaction(read)
+
+    if exported is None:
+        return
+
+    if not exported:
+        return 0
+
+    categories, questions, last_change_id, database_id, read_count = exported
+
+    try:
+        write_snapshot(path, categories, questions, last_change_id, database_id)
+    except OSError as e:
+        print(e)
+        return
+
+    return read_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the synchronised questions to a read-only snapshot file for serving nodes')
+    parser.add_argument('-o', '--output', help='snapshot file to write', default=snapshot_path() or DEFAULT_SNAPSHOT_PATH)
+    parser.add_argument('--full', action='store_true', help='read every question from the database rather than only those changed since the last snapshot')
+    args = parser.parse_args()
+
+    read_count = export_snapshot(args.output, args.full)
+
+    if read_count is None:
+        print("Unable to export a snapshot")
+        sys.exit(1)
+
+    print(f"Snapshot {args.output} is up to date - read {read_count} questions from the database")
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+import html
+import json
+import time
+import base64
+import random
+import secrets
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs, quote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+MAX_QUESTIONS = 50
+FIRST_CATEGORY = 9
+DIFFICULTIES = ['easy', 'medium', 'hard']
+
+
+class TriviaDataset:
+
+    """ Generated questions and session tokens served by the stand-in API
+    """
+
+    def __init__(self, categories, questions_per_category, seed = 0):
+
+        """ :param categories: Number of categories to generate
+            :param questions_per_category: Number of questions to generate for each category
+            :param seed: Seed for the random choices so datasets can be reproduced
+        """
+
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.categories = {}
+        self.questions = []
+        self.tokens = {}
+
+        for category_id in range(FIRST_CATEGORY, FIRST_CATEGORY + categories):
+            self.categories[category_id] = f"Category {category_id}: Stand-in &amp; Test"
+
+        self.add_questions(questions_per_category)
+
+    def add_questions(self, count):
+
+        """ Add new questions to every category, eg to measure an incremental sync
+
+            :param count: Number of questions to add to each category
+        """
+
+        with self.lock:
+            for category_id, category_name in self.categories.items():
+                for _ in range(count):
+                    number = len(self.questions)
+                    question_type = self.random.choice(['multiple', 'boolean'])
+                    question = {
+                        'type': question_type,
+                        'difficulty': self.random.choice(DIFFICULTIES),
+                        'category': category_name,
+                        'question': f"Stand-in question {number} for category {category_id} - what&#039;s the &quot;answer&quot;?"
+                    }
+
+                    if question_type == 'boolean':
+                        question['correct_answer'] = self.random.choice(["True", "False"])
+                        question['incorrect_answers'] = ["False" if question['correct_answer'] == "True" else "True"]
+                    else:
+                        question['correct_answer'] = f"Right answer {number}"
+                        question['incorrect_answers'] = [f"Wrong answer {number}.{n}" for n in range(3)]
+
+                    self.questions.append((category_id, question))
+
+    def matching(self, category_id = None, difficulty = None, question_type = None):
+
+        """ :return: List of (index, question) tuples matching the given filters
+        """
+
+        return [
+            (index, question) for index, (question_category, question) in enumerate(self.questions)
+            if (category_id is None or question_category == category_id)
+            and (difficulty is None or question['difficulty'] == difficulty)
+            and (question_type is None or question['type'] == question_type)
+        ]
+
+    def category_counts(self, category_id):
+
+        """ :return: dict of question counts for the category, in the api_count.php format
+        """
+
+        matches = [question for index, question in self.matching(category_id)]
+        counts = {'total_question_count': len(matches)}
+
+        for difficulty in DIFFICULTIES:
+            counts[f"total_{difficulty}_question_count"] = len([question for question in matches if question['difficulty'] == difficulty])
+
+        return counts
+
+
+class FakeOpenTDBHandler(BaseHTTPRequestHandler):
+
+    """ Answers requests the way the Open Trivia API does
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        endpoint = url.path.strip('/')
+        parameters = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        server = self.server
+
+        if endpoint == '_stats':
+            # Request counts by endpoint
+            with server.stats_lock:
+                return self.send_json(dict(server.stats))
+
+        with server.stats_lock:
+            server.stats[endpoint] = server.stats.get(endpoint, 0) + 1
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.rate_limited(self.client_address[0]):
+            return self.send_json({'response_code': 5, 'results': []})
+
+        handlers = {
+            'api.php': self.questions,
+            'api_count.php': self.category_count,
+            'api_count_global.php': self.global_count,
+            'api_category.php': self.category_list,
+            'api_token.php': self.token
+        }
+
+        if not endpoint in handlers:
+            self.send_error(404)
+            return
+
+        try:
+            self.send_json(handlers[endpoint](server.dataset, parameters))
+        except (KeyError, ValueError):
+            self.send_json({'response_code': 2, 'results': []})
+
+    def questions(self, dataset, parameters):
+        amount = int(parameters['amount'])
+        category_id = int(parameters['category']) if 'category' in parameters else None
+        difficulty = parameters.get('difficulty')
+        encoding = parameters.get('encode')
+
+        # Check every parameter before picking, so an invalid request doesn't use up questions for the token
+        if not 0 < amount <= MAX_QUESTIONS or (category_id is not None and not category_id in dataset.categories) or (encoding and not encoding in ['url3986', 'base64']):
+            return {'response_code': 2, 'results': []}
+
+        with dataset.lock:
+            token = parameters.get('token')
+
+            if token is not None and not token in dataset.tokens:
+                # Token not found
+                return {'response_code': 3, 'results': []}
+
+            matches = dataset.matching(category_id, difficulty, parameters.get('type'))
+
+            if len(matches) < amount:
+                # Not enough questions for the query
+                return {'response_code': 1, 'results': []}
+
+            if token is not None:
+                served = dataset.tokens[token]
+                matches = [(index, question) for index, question in matches if not index in served]
+
+                if not matches:
+                    # Token has returned all possible questions for the query
+                    return {'response_code': 4, 'results': []}
+
+            picked = dataset.random.sample(matches, min(amount, len(matches)))
+
+            if token is not None:
+                dataset.tokens[token].update(index for index, question in picked)
+
+        return {'response_code': 0, 'results': [encode_question(question, encoding) for index, question in picked]}
+
+    def category_count(self, dataset, parameters):
+        category_id = int(parameters['category'])
+
+        with dataset.lock:
+            return {
+                'category_id': category_id,
+                'category_question_count': dataset.category_counts(category_id)
+            }
+
+    def global_count(self, dataset, parameters):
+        with dataset.lock:
+            categories = {}
+
+            for category_id in dataset.categories:
+                total = dataset.category_counts(category_id)['total_question_count']
+                categories[str(category_id)] = {
+                    'total_num_of_questions': total,
+                    'total_num_of_pending_questions': 0,
+                    'total_num_of_verified_questions': total,
+                    'total_num_of_rejected_questions': 0
+                }
+
+            total = len(dataset.questions)
+
+        return {
+            'overall': {
+                'total_num_of_questions': total,
+                'total_num_of_pending_questions': 0,
+                'total_num_of_verified_questions': total,
+                'total_num_of_rejected_questions': 0
+            },
+            'categories': categories
+        }
+
+    def category_list(self, dataset, parameters):
+        with dataset.lock:
+            return {'trivia_categories': [{'id': category_id, 'name': name} for category_id, name in dataset.categories.items()]}
+
+    def token(self, dataset, parameters):
+        with dataset.lock:
+            if parameters['command'] == 'reset':
+                if not parameters['token'] in dataset.tokens:
+                    return {'response_code': 3, 'token': ""}
+
+                dataset.tokens[parameters['token']] = set()
+                return {'response_code': 0, 'token': parameters['token']}
+
+            token = secrets.token_hex(32)
+            dataset.tokens[token] = set()
+
+        return {'response_code': 0, 'response_message': "Token Generated Successfully!", 'token': token}
+
+    def send_json(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', "application/json")
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep benchmark output readable
+        pass
+
+
+def encode_question(question, encoding):
+
+    """ Encode the text of a question as requested with the encode parameter
+
+        :param question: Question dictionary with HTML entities, as the API returns by default
+        :param encoding: None, 'url3986' or 'base64'
+        :return: Question dictionary
+    """
+
+    if not encoding:
+        return question
+
+    def encode(value):
+        text = html.unescape(value)
+
+        if encoding == 'url3986':
+            return quote(text, safe='')
+
+        return base64.b64encode(text.encode('utf-8')).decode('ascii')
+
+    encoded = {key: encode(value) for key, value in question.items() if key != 'incorrect_answers'}
+    encoded['incorrect_answers'] = [encode(value) for value in question['incorrect_answers']]
+
+    return encoded
+
+
+class FakeOpenTDBServer(ThreadingHTTPServer):
+
+    """ Stand-in for opentdb.com with configurable latency and rate limit
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, dataset, latency = 0, rate_interval = 0):
+
+        """ :param address: (host, port) tuple to listen on - use port 0 to pick a free port
+            :param dataset: TriviaDataset to serve
+            :param latency: Seconds to wait before answering each request
+            :param rate_interval: Minimum seconds between requests from a client - closer requests get response code 5
+        """
+
+        super().__init__(address, FakeOpenTDBHandler)
+        self.dataset = dataset
+        self.latency = latency
+        self.rate_interval = rate_interval
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.last_request = {}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def rate_limited(self, client):
+
+        """ :return: True if the client has made a request within the rate interval
+        """
+
+        if not self.rate_interval:
+            return False
+
+        now = time.monotonic()
+
+        with self.stats_lock:
+            previous = self.last_request.get(client)
+            self.last_request[client] = now
+
+        return previous is not None and now - previous < self.rate_interval
+
+    def start(self):
+
+        """ Serve requests on a background thread
+
+            :return: The server
+        """
+
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the Open Trivia API')
+    parser.add_argument('--host', help='address to listen on', default='127.0.0.1')
+    parser.add_argument('--port', help='port to listen on', type=int, default=8000)
+    parser.add_argument('--categories', help='number of categories', type=int, default=5)
+    parser.add_argument('--questions', help='number of questions per category', type=int, default=200)
+    parser.add_argument('--latency', help='seconds to wait before answering each request', type=float, default=0)
+    parser.add_argument('--rate-interval', help='minimum seconds between requests before response code 5 is returned', type=float, default=0)
+    args = parser.parse_args()
+
+    server = FakeOpenTDBServer((args.host, args.port), TriviaDataset(args.categories, args.questions), args.latency, args.rate_interval)
+    print(f"Serving stand-in Open Trivia API at {server.base_url}")
+    server.serve_forever()
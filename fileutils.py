@@ -0,0 +1,38 @@
+import os
+import tempfile
+
+# Read once at import, as os.umask() can only be read by setting it
+umask = os.umask(0)
+os.umask(umask)
+
+
+def write_atomically(path, write, binary = False):
+
+    """ Write a file via a uniquely named temporary file in the same directory, then rename it into place
+
+        Readers never see a partial file, and processes writing the same file at once can't rename each other's
+        temporary files away - the last rename wins
+
+        :param path: File to write
+        :param write: Function to call with the open temporary file
+        :param binary: Open the temporary file in binary mode
+    """
+
+    directory, filename = os.path.split(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{filename}.", suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, 'wb' if binary else 'w') as temp_file:
+            write(temp_file)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+
+        # mkstemp() makes files only the owner can read - keep the mode of the file being replaced, or the usual default
+        os.chmod(temp_path, os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o666 & ~umask)
+        os.replace(temp_path, path)
+
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        raise
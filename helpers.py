@@ -1,13 +1,100 @@
+import os
 import sys
+import copy
+import json
+import math
+import time
+import random
+import socket
 import requests   
+import threading
 import configparser
-from mysql.connector import connect, Error
+from urllib.parse import urlencode
+from contextlib import contextmanager
+from queue import Queue, Full
+import metrics
+import storage
+from fileutils import write_atomically
+from records import API_ENCODING, decode_page, escape_html, question_fingerprint, stored_content_fingerprint
 
-MIN_CAT_NUM = 9
 MAX_QUESTIONS = 50
+DEFAULT_QUEUE_DEPTH = 4
+PIPELINE_POLL_INTERVAL = 0.5
+
+RATE_LIMIT_RESPONSE_CODE = 5
+
+# Open Trivia allows one request every 5 seconds per IP
+DEFAULT_API_RATE = 0.2
+DEFAULT_API_BURST = 1
+DEFAULT_API_URL = "https://opentdb.com/"
+DEFAULT_HTTP_POOL_SIZE = 4
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_BUDGET = 50
+DEFAULT_BACKOFF_BASE = 5
+DEFAULT_BACKOFF_MAX = 120
+DEFAULT_CACHE_TTL = 3600
+DEFAULT_TOKEN_FILE = "apitoken.ini"
+DEFAULT_LEASE_TTL = 300
+
+# Heartbeats sent per lease_ttl, so a lease survives a missed heartbeat or two
+LEASE_HEARTBEATS = 3
+
+# Open Trivia session tokens expire after 6 hours
+TOKEN_LIFETIME = 6 * 60 * 60
+TOKEN_REFRESH_MARGIN = 10 * 60
+
+# Marks the end of a producer's output in run_pipeline()
+PIPELINE_DONE = object()
 
 trivia_categories = {}
 
+# Storage backend selected in appconfig.ini - see storage_backend()
+backend = None
+
+# Name given to this worker with set_worker() - see worker_name()
+worker_id = None
+
+# Lock file held while this process uses the token file - see claim_token_file()
+token_lock = None
+
+# Session token held in memory - only written to the token file when it changes
+token_store = {
+    'lock': threading.RLock(),
+    'token': None,
+    'issued': None,
+    'loaded': False
+}
+
+# Local question counts by category and difficulty - see local_counts()
+count_index = None
+
+# Per category/level sync progress - see sync_journal()
+journal = None
+
+# Fingerprints of the questions in the local database - see known_fingerprints()
+fingerprints = None
+
+# (category id, level) of the levels left unfinished by a failed request or page write - see fetch_pages()
+failed_levels = []
+
+# Responses from the count and category lookups, keyed by request
+lookup_cache = None
+
+# Keep-alive HTTP session for API calls - see api_session()
+http_session = None
+
+# Shared state for the API request scheduler
+scheduler = {
+    'lock': threading.Lock(),
+    'tokens': 0,
+    'updated': None,
+    'throttled': 0.0,
+    'backed_off': 0.0,
+    'retries': 0
+}
+
 
 # Get database credentials from config file
 config = configparser.ConfigParser()
@@ -26,314 +113,1263 @@ def update_trivia_categories():
         'endpoint': 'api_category.php'
     }
 
-    latest_categories =  api_request(req_details, False)
+    latest_categories =  cached_lookup(req_details)
 
     for category in latest_categories:
         # Populate trivia_categories with category number/name pairs
         trivia_categories[category['id']] = category['name']
 
 
-def get_category(category_id):
+def sync_plan(token = None, refresh = False):
+
+    """ Compare the API's question counts with ours for every category at once and list the questions still to fetch
+
+        :param token: Token the plan will be carried out with, or None for a new token
+        :param refresh: Fetch every question, not just missing ones, so upstream corrections are picked up
+        :return: List of plan steps from category_plan(), largest gap first
+    """
+
+    plan = []
+
+    for category_id in sorted(trivia_categories):
+        # The global snapshot has totals for every category - if ours matches there's no need to ask for the level breakdown
+        if not refresh and question_breakdown()['global'].get(category_id) == questions_done(category_id)['category']:
+            continue
+
+        plan.extend(category_plan(category_id, token, refresh))
+
+    plan.sort(key=lambda step: (-step['gap'], step['category'], step['level']))
+
+    return plan
+
+
+def category_plan(category_id, token = None, refresh = False):
+
+    """ List the questions still to fetch for a category - helper for sync_plan()
+
+        :param category_id: Category to plan
+        :param token: Token the plan will be carried out with, or None for a new token
+        :param refresh: Fetch every question the token can return, not just missing ones
+        :return: List of plan steps, each a dict with
+            - 'category' id number
+            - 'level' difficulty level
+            - 'available' questions the API has for the level
+            - 'gap' questions missing from the local database - or every question available when refreshing
+            - 'budget' questions the token can still return for the level
+            - 'resuming' True if an earlier run made progress on the level with this token
+    """
+
+    category = question_breakdown(category_id)['category']
+    steps = []
+
+    for level, done in level_counts(category_id).items():
+        available = category.get(f"total_{level}_question_count", 0)
+
+        # A gap that new questions alone can't fill keeps the level going until the token has returned everything
+        gap = available if refresh else available - done
+
+        if gap <= 0:
+            continue
+
+        entry = sync_journal().get((category_id, level))
+        fetched = 0
+
+        if token and entry and entry['token'] == token:
+            if entry['completed'] and entry['target'] == available:
+                # The token has already returned everything it can for this level
+                continue
+
+            fetched = entry['questions_fetched']
+
+        budget = available - fetched
+
+        if budget > 0:
+            steps.append({
+                'category': category_id,
+                'level': level,
+                'available': available,
+                'gap': gap,
+                'budget': budget,
+                'resuming': fetched > 0
+            })
+
+    return steps
+
+
+def plan_estimate(plan):
+
+    """ Estimate the cost of carrying out a sync plan
+
+        Assumes every question returned is new - duplicates returned with a fresh token mean more requests
+
+        :param plan: List of plan steps from sync_plan()
+        :return: dict with the number of question requests and the seconds the rate limit will spread them over
+    """
+
+    requests_needed = sum(math.ceil(min(step['gap'], step['budget']) / MAX_QUESTIONS) for step in plan)
+    rate = config.getfloat('apiconfig', 'rate', fallback=DEFAULT_API_RATE)
+    burst = config.getfloat('apiconfig', 'burst', fallback=DEFAULT_API_BURST)
+
+    return {
+        'requests': requests_needed,
+        'seconds': max(0, requests_needed - burst) / rate if rate > 0 else 0.0
+    }
+
+
+def process_plan(plan, refresh = False):
+
+    """ Fetch the questions listed in a sync plan and add them to the local database
+
+        Each category is leased before it is synchronised, so any number of workers can share the plan without
+        two of them fetching the same category
+
+        :param plan: List of plan steps from sync_plan()
+        :param refresh: The plan was made to refresh every question
+    """
+
+    # Categories in the order their largest gap appears in the plan
+    pending = list(dict.fromkeys(step['category'] for step in plan))
+    create_leases(pending)
+
+    while pending:
+        category_id = claim_category(pending)
+
+        if category_id is None:
+            print(f"\nCategories {', '.join(str(category_id) for category_id in pending)} are being synchronised by other workers\n")
+            break
+
+        pending.remove(category_id)
+
+        with category_lease(category_id) as lease_lost:
+            # Another worker may have synchronised the category since the plan was made
+            refresh_category(category_id)
+
+            for step in category_plan(category_id, session_token(), refresh):
+                # Read for each step, as the token may have been replaced since the last one
+                process_step(step, session_token(), lease_lost)
+
+
+def process_step(step, token, lease_lost):
+
+    """ Fetch the missing questions for one level of a category - helper for process_plan()
+
+        :param step: Plan step from category_plan()
+        :param token: Session token to request questions with
+        :param lease_lost: threading.Event set if the category lease can't be renewed
+    """
+
+    category_id = step['category']
+    entry = journal_level(category_id, step['level'], step['available'], token)
+
+    if entry['completed']:
+        print(f"Category {category_id} ({step['level']}): already synchronised with the current token")
+        return
+
+    # Questions already fetched with this token won't be returned again, so only ask for the rest
+    level = {
+        'level': step['level'],
+        'gap': step['gap'],
+        'count': step['available'] - entry['questions_fetched'],
+        'available': step['available'],
+        'token': token
+    }
+
+    print(f"\nCategory {category_id} ({step['level']}): fetching {min(step['gap'], level['count'])} questions\n")
+
+    def leased_pages():
+        for page in fetch_pages(category_id, [level]):
+            if lease_lost.is_set():
+                print(f"\nWARNING: lost the lease on category {category_id} - leaving it to another worker\n")
+                return
+
+            yield page
+
+    # Fetch and decode each page from the API while the previous one is being written to the database
+    with metrics.timed('category_sync_seconds', category=category_id):
+        run_pipeline(leased_pages, process_page)
+
+
+def create_leases(category_ids):
+
+    """ Make sure each category has a row in the lease table
+
+        :param category_ids: List of category id numbers
+    """
+
+    if not category_ids:
+        return
+
+    db = storage_backend()
+    db_transaction(lambda cursor: cursor.execute(db.insert_ignore_sql('category_leases', ['category_id'], len(category_ids)), category_ids))
+
+
+def claim_category(category_ids):
+
+    """ Lease the first of the given categories that no other worker holds
+
+        :param category_ids: Category id numbers in order of preference
+        :return: Id number of the leased category or None if they're all held by other workers
+    """
+
+    db = storage_backend()
+    worker = worker_name()
+    ttl = config.getfloat('syncconfig', 'lease_ttl', fallback=DEFAULT_LEASE_TTL)
+    placeholders = ", ".join(["%s"] * len(category_ids))
+
+    def claim(cursor):
+        now = time.time()
+        claimable = "(worker IS NULL OR worker = %s OR expires_at < %s)"
+
+        # Rows being claimed by other workers are skipped rather than waited for
+        free = {row[0] for row in fetch_all(cursor, f"SELECT category_id FROM category_leases WHERE category_id IN ({placeholders}) AND {claimable}{db.skip_locked}", category_ids + [worker, now])}
+
+        for category_id in category_ids:
+            if not category_id in free:
+                continue
+
+            # Repeat the check so a worker that read the row at the same time can't take it too
+            cursor.execute(f"UPDATE category_leases SET worker = %s, expires_at = %s, heartbeat_at = %s WHERE category_id = %s AND {claimable}", (worker, now + ttl, now, category_id, worker, now))
+
+            if cursor.rowcount == 1:
+                return category_id
+
+    return db_transaction(claim)
+
+
+def renew_lease(category_id):
+
+    """ Extend this worker's lease on a category
+
+        :param category_id: Leased category
+        :return: False if the lease has been taken by another worker, else True
+    """
+
+    now = time.time()
+    ttl = config.getfloat('syncconfig', 'lease_ttl', fallback=DEFAULT_LEASE_TTL)
+
+    def renew(cursor):
+        cursor.execute("UPDATE category_leases SET expires_at = %s, heartbeat_at = %s WHERE category_id = %s AND worker = %s", (now + ttl, now, category_id, worker_name()))
+        return cursor.rowcount == 1
+
+    # A failed query isn't proof the lease has gone - the next heartbeat will tell
+    return db_transaction(renew) is not False
+
+
+def release_lease(category_id):
+
+    """ Give up this worker's lease on a category
+
+        :param category_id: Leased category
+    """
+
+    db_transaction(lambda cursor: cursor.execute("UPDATE category_leases SET worker = NULL, expires_at = NULL, heartbeat_at = NULL WHERE category_id = %s AND worker = %s", (category_id, worker_name())))
+
+
+@contextmanager
+def category_lease(category_id):
+
+    """ Keep a claimed category leased with heartbeats, releasing it at the end of the with statement
+
+        :param category_id: Category claimed with claim_category()
+        :return: threading.Event set if the lease is lost
+    """
+
+    lease_lost = threading.Event()
+    stopping = threading.Event()
+    interval = config.getfloat('syncconfig', 'lease_ttl', fallback=DEFAULT_LEASE_TTL) / LEASE_HEARTBEATS
+
+    def heartbeat():
+        while not stopping.wait(interval):
+            if not renew_lease(category_id):
+                lease_lost.set()
+                return
+
+    worker = threading.Thread(target=heartbeat, daemon=True)
+    worker.start()
+
+    try:
+        yield lease_lost
+    finally:
+        stopping.set()
+        worker.join()
+        release_lease(category_id)
+
+
+def refresh_category(category_id):
+
+    """ Re-read the local counts and fingerprints for a category, picking up questions added by other workers
+
+        :param category_id: Category to refresh
+    """
+
+    def read(cursor):
+        counts = fetch_all(cursor, "SELECT difficulty, COUNT(*) FROM questions WHERE category_id = %s GROUP BY difficulty", (category_id,))
+        hashes = fetch_all(cursor, "SELECT question_hash, content_hash FROM questions WHERE category_id = %s AND question_hash IS NOT NULL", (category_id,))
+        return counts, hashes
+
+    result = db_transaction(read)
+
+    if result is None:
+        return
+
+    counts, hashes = result
+    local_counts()[category_id] = {difficulty: count for difficulty, count in counts}
+    known_fingerprints().update((bytes(fingerprint), content_hash and bytes(content_hash)) for fingerprint, content_hash in hashes)
+
+
+def worker_name():
+
+    """ :return: Name this worker holds leases under - the host name and process id unless set with set_worker()
+    """
+
+    if worker_id is None:
+        return f"{socket.gethostname()}-{os.getpid()}"
+
+    return worker_id
+
+
+def set_worker(name):
+
+    """ Name this worker and give it a session token of its own
+
+        :param name: Worker name - unique among the workers sharing the database
+    """
+
+    global worker_id
+
+    worker_id = name
+
+
+def fetch_pages(category_id, levels, decode = True):
+
+    """ Request pages of questions from the API - producer for run_pipeline()
+
+        Each level ends when its gap has been filled, the token has returned all it can, the API has no more questions
+        (response code 4) or a request fails
+
+        :param category_id: Id number of current category
+        :param levels: List of dictionaries with difficulty level, the number of questions the token can return and optionally
+            the number missing, the number available and the token the count applies to
+            eg [{'level': 'easy', 'count': 100, 'gap': 3, 'available': 120, 'token': "abc123"}]
+        :param decode: Decode pages into Question records - the raw question dictionaries are passed on if False
+        :return: Generator of (questions, req_details) tuples, one per page - questions is an empty list once the API has
+            no more for the level
+    """
+
+    known = known_fingerprints() if decode else set()
+
+    for to_do in levels:
+        budget = to_do['count']
+        gap = to_do.get('gap', budget)
+        seen = set()
+
+        while gap > 0 and budget > 0:
+            if (category_id, to_do['level']) in failed_levels:
+                # A page of the level couldn't be written - don't fetch any more of it this run
+                break
+
+            # Once a token has returned what we have, the budget is just the missing questions. A fresh token may return
+            # questions we already have, so ask for full pages then - a request costs the same whatever the amount.
+            req_details = page_request(category_id, to_do['level'], min(MAX_QUESTIONS, budget))
+
+            # API will return unique questions because we're using a token
+            questions = api_request(req_details)
+
+            if questions is None:
+                # Nothing to checkpoint - the level is left for the next run to pick up
+                print(f"\nWARNING: request for category {category_id} ({to_do['level']}) failed - leaving the rest of the level for the next run\n")
+                failed_levels.append((category_id, to_do['level']))
+                break
+
+            if decode:
+                questions = decode_page(category_id, questions)
+
+                # Worked out before the page is passed on, as the consumer adds its fingerprints to known
+                new_fingerprints = {question.fingerprint for question in questions if not question.fingerprint in known} - seen
+
+            # Pass an empty page on so the consumer knows the level has ended early
+            yield questions, req_details
+
+            if not questions:
+                # The API has no more questions for the token (response code 4)
+                break
+
+            if 'token' in to_do and req_details.get('token') != to_do['token']:
+                # The token was replaced part way through the level - the new one can return every question
+                to_do['token'] = req_details.get('token')
+                budget = to_do['available']
+
+            budget -= len(questions)
+
+            if decode:
+                seen.update(new_fingerprints)
+                gap -= len(new_fingerprints)
+            else:
+                gap -= len(questions)
+
+
+def page_request(category_id, difficulty_level, amount):
+
+    """ Get the details of a request for a page of questions - restrict to difficulty level if provided
+
+        :param category_id: Id number of current category
+        :param difficulty_level: Difficulty level or 'all'
+        :param amount: Number of questions to request
+        :return: req_details dictionary
+    """
+
+    # Each page gets its own dictionary as it may still be queued while the next is requested
+    req_details = {
+        'callback': lambda questions, req_details: questions,
+        'endpoint': 'api.php',
+        'parameters': {
+            'category': category_id,
+            'amount': amount,
+            # Decoded once by decode_page() rather than on every read of the stored text
+            'encode': API_ENCODING
+        }
+    }
+
+    if not difficulty_level == "all":
+        req_details['parameters']['difficulty'] = difficulty_level
+
+    return req_details
+
+
+def run_pipeline(produce, consume):
+
+    """ Run a producer and a consumer concurrently, joined by a bounded queue
+
+        :param produce: Function returning an iterable of argument tuples - runs on a worker thread
+        :param consume: Function called on the current thread with each tuple produced
+    """
+
+    items = Queue(maxsize=config.getint('syncconfig', 'queue_depth', fallback=DEFAULT_QUEUE_DEPTH))
+    stopping = threading.Event()
+
+    def producer():
+        try:
+            for item in produce():
+                if not pipeline_put(items, item, stopping):
+                    # Consumer has given up
+                    return
+
+            item = PIPELINE_DONE
+
+        except BaseException as e:
+            # Pass failures (including sys.exit() on fatal response codes) to the consumer to re-raise
+            item = e
+
+        pipeline_put(items, item, stopping)
+
+    worker = threading.Thread(target=producer, daemon=True)
+    worker.start()
+
+    try:
+        while True:
+            item = items.get()
+
+            if item is PIPELINE_DONE:
+                break
+
+            if isinstance(item, BaseException):
+                raise item
+
+            consume(*item)
+
+    finally:
+        stopping.set()
+        worker.join()
+
+
+def pipeline_put(items, item, stopping):
+
+    """ Add an item to the pipeline queue, waiting for space - helper for run_pipeline()
+
+        :param items: The pipeline queue
+        :param item: Item to add
+        :param stopping: Event set when the consumer has finished
+        :return: False if the consumer finished before there was space, else True
+    """
+
+    while not stopping.is_set():
+        try:
+            items.put(item, timeout=PIPELINE_POLL_INTERVAL)
+            return True
+        except Full:
+            continue
+
+    return False
+
+
+def process_page(questions, req_details):
+
+    """ Add a page of questions to the local database - consumer for run_pipeline()
+
+        :param questions: A list of Question records - empty if the API had no more questions for the level
+        :param: req_details: The url segments used for the api request
+        :return: List of the Question records that were added or None
+    """
+
+    category_id = req_details['parameters']['category']
+    level = req_details['parameters'].get('difficulty', "all")
+
+    if (category_id, level) in failed_levels:
+        # An earlier page of the level couldn't be written - drop any pages already queued behind it
+        return
+
+    if not questions:
+        # Mark the level done so it isn't requested again with this token
+        entry = db_transaction(lambda cursor: record_page(cursor, category_id, level, req_details.get('token'), 0, 0, True))
+
+        if entry is None:
+            write_failed(category_id, level)
+            return
+
+        sync_journal()[(category_id, level)] = entry
+        return
+
+    return process_questions(questions, req_details)
+
+
+def write_failed(category_id, level):
+
+    """ Leave a level unfinished after a page of it couldn't be written, the same as after a failed request
+
+        :param category_id: Id number of the category
+        :param level: Difficulty of the level or "all"
+    """
+
+    print(f"\nWARNING: unable to save a page of category {category_id} ({level}) - leaving the rest of the level for the next run\n")
+    failed_levels.append((category_id, level))
+
+
+def process_questions(questions, req_details):
+
+    """ Add the given questions to the local database, updating any that have been corrected upstream
+
+        :param questions: A list of Question records
+        :param: req_details: The url segments used for the api request
+        :return: List of the Question records that were added or None
+    """    
+    category_id = req_details[ 'parameters']['category']
+    level = req_details['parameters'].get('difficulty', "all")
+    category_name = None
+    new_questions = {}
+    changed_questions = {}
+
+    if len(questions):
+        category_name = questions[0].category
+        known = known_fingerprints()
+
+        for question in questions:
+            if question.fingerprint in new_questions or question.fingerprint in changed_questions:
+                # Repeated within the page
+                continue
+
+            if not question.fingerprint in known:
+                new_questions[question.fingerprint] = question
+
+            elif known[question.fingerprint] != question.content_hash:
+                # Question, answers, difficulty or type have been corrected since we stored it
+                changed_questions[question.fingerprint] = question
+
+            # Anything else we already have, unchanged - drop it before it reaches the database
+
+    else:
+        # No questions were provided - print a warning so it can be looked into if necessary
+        print(f"\nWARNING: No questions provided to process_questions() for category {category_id}\n")
+
+    def write_page(cursor):
+        added = insert_page(cursor, category_id, category_name, list(new_questions.values())) if new_questions else []
+        updated = update_page(cursor, list(changed_questions.values())) if changed_questions else []
+
+        # Checkpoint in the same transaction so the journal never disagrees with the rows
+        return added, updated, record_page(cursor, category_id, level, req_details.get('token'), len(questions), len(added))
+
+    # Write the whole page in a single transaction
+    written = db_transaction(write_page)
+
+    if written is None:
+        write_failed(category_id, level)
+        return
+
+    added, updated, entry = written
+    sync_journal()[(category_id, level)] = entry
+
+    # Whether added or found in the database, these are all known now
+    known_fingerprints().update((question.fingerprint, question.content_hash) for question in new_questions.values())
+    known_fingerprints().update((question.fingerprint, question.content_hash) for question, stored_category, stored_difficulty in updated)
+    count_added(category_id, added)
+
+    for question, stored_category, stored_difficulty in updated:
+        if question.difficulty != stored_difficulty:
+            levels = local_counts().setdefault(stored_category, {})
+            levels[stored_difficulty] = levels.get(stored_difficulty, 0) - 1
+            levels[question.difficulty] = levels.get(question.difficulty, 0) + 1
+
+    metrics.increment('questions_inserted_total', len(added), category=category_id)
+    metrics.increment('questions_updated_total', len(updated), category=category_id)
+    metrics.increment('questions_skipped_total', len(questions) - len(added) - len(updated), category=category_id)
+
+    return added
+
+
+def insert_page(cursor, category_id, category_name, questions):
+
+    """ Bulk insert a page of questions and their answers - helper for process_questions()
+
+        :param cursor: Cursor for the open transaction
+        :param category_id: Id number of the category the questions belong to
+        :param category_name: Name of the category
+        :param questions: A list of Question records
+        :return: List of the Question records that were added - duplicates are skipped
+    """
+
+    # Make sure category exists
+    cursor.execute(storage_backend().insert_ignore_sql('categories', ['id', 'category']), (category_id, category_name))
+
+    fingerprints = [question.fingerprint for question in questions]
+    fingerprint_placeholders = ", ".join(["%s"] * len(fingerprints))
+    select_ids = f"SELECT id, question_hash FROM questions WHERE question_hash IN ({fingerprint_placeholders})"
+
+    # Note which of these questions we already have so we can tell them apart from the ones we're about to add
+    cursor.execute(select_ids, fingerprints)
+    existing_ids = {row[0] for row in cursor.fetchall()}
+
+    question_values = [value for question in questions for value in question.question_row()]
+
+    cursor.execute(storage_backend().insert_ignore_sql('questions', ['category_id', 'type', 'difficulty', 'question_text', 'question_html', 'question_hash', 'content_hash'], len(questions)), question_values)
+
+    # Any id we didn't have before the insert belongs to a question we've just added
+    cursor.execute(select_ids, fingerprints)
+    new_ids = {bytes(fingerprint): question_id for question_id, fingerprint in cursor.fetchall() if question_id not in existing_ids}
+
+    # Anything without a new id was skipped as a duplicate
+    added = [question for question in questions if question.fingerprint in new_ids]
+    answer_values = [row for question in added for row in question.answer_rows(new_ids[question.fingerprint])]
+
+    if len(answer_values):
+        cursor.executemany("INSERT INTO answers (question_id, answer, answer_html, correct) VALUES (%s, %s, %s, %s)", answer_values)
+
+    if added:
+        # The documents include the question ids, so can only be written once the rows exist. A multi-row upsert writes
+        # them in one statement - the NOT NULL columns are repeated as they're checked before the key conflict is found.
+        cursor.execute(
+            storage_backend().upsert_sql('questions', ['id', 'category_id', 'type', 'difficulty', 'question_text', 'document', 'document_html'], ['id'], len(added), ['document', 'document_html']),
+            [value for question in added for value in (new_ids[question.fingerprint],) + question.question_row()[:4] + question.documents(new_ids[question.fingerprint])]
+        )
+
+        record_changes(cursor, [(new_ids[question.fingerprint], category_id, question.difficulty, 'insert') for question in added])
+
+    return added
+
+
+def update_page(cursor, questions):
+
+    """ Rewrite stored questions, and their answers, that have been corrected upstream - helper for process_questions()
+
+        :param cursor: Cursor for the open transaction
+        :param questions: A list of Question records whose content fingerprint differs from the stored one
+        :return: List of (Question, stored category id, stored difficulty) tuples for the questions updated
+    """
+
+    fingerprint_placeholders = ", ".join(["%s"] * len(questions))
+    stored = {
+        bytes(fingerprint): (question_id, category_id, difficulty, question_type)
+        for question_id, fingerprint, category_id, difficulty, question_type
+        in fetch_all(cursor, f"SELECT id, question_hash, category_id, difficulty, type FROM questions WHERE question_hash IN ({fingerprint_placeholders})", [question.fingerprint for question in questions])
+    }
+
+    # A question removed since the fingerprints were read has nothing to update
+    questions = [question for question in questions if question.fingerprint in stored]
+
+    if not questions:
+        return []
+
+    question_ids = [stored[question.fingerprint][0] for question in questions]
+    id_placeholders = ", ".join(["%s"] * len(question_ids))
+
+    cursor.executemany(
+        "UPDATE questions SET type = %s, difficulty = %s, question_text = %s, question_html = %s, content_hash = %s, document = %s, document_html = %s WHERE id = %s",
+        [(question.type, question.difficulty, question.text, escape_html(question.text), question.content_hash) + question.documents(stored[question.fingerprint][0]) + (stored[question.fingerprint][0],) for question in questions]
+    )
+
+    cursor.execute(f"DELETE FROM answers WHERE question_id IN ({id_placeholders})", question_ids)
+    cursor.executemany("INSERT INTO answers (question_id, answer, answer_html, correct) VALUES (%s, %s, %s, %s)", [row for question in questions for row in question.answer_rows(stored[question.fingerprint][0])])
+
+    # Questions that have changed bucket are given a new position by the next refresh_question_sequence()
+    moved = [stored[question.fingerprint][0] for question in questions if stored[question.fingerprint][2:] != (question.difficulty, question.type)]
+
+    if moved:
+        remove_from_sequence(cursor, moved)
+
+    record_changes(cursor, [(stored[question.fingerprint][0], stored[question.fingerprint][1], question.difficulty, 'update') for question in questions])
+
+    return [(question, stored[question.fingerprint][1], stored[question.fingerprint][2]) for question in questions]
+
+
+def record_changes(cursor, changes):
+
+    """ Append to the change feed in the transaction that made the changes
+
+        Change ids are taken from the single changefeed_head row, which stays locked until the transaction ends, so
+        ids are assigned in commit order and a reader never sees a later id before an earlier one
+
+        :param cursor: Cursor for the open transaction
+        :param changes: List of (question_id, category_id, difficulty, change_type) tuples
+    """
+
+    cursor.execute("UPDATE changefeed_head SET last_change_id = last_change_id + %s WHERE id = 1", (len(changes),))
+    cursor.execute("SELECT last_change_id FROM changefeed_head WHERE id = 1")
+    first_change_id = cursor.fetchone()[0] - len(changes) + 1
+
+    cursor.executemany(
+        "INSERT INTO question_changes (change_id, question_id, category_id, difficulty, change_type) VALUES (%s, %s, %s, %s, %s)",
+        [(first_change_id + offset,) + tuple(change) for offset, change in enumerate(changes)]
+    )
+
+
+def questions_done(category_id = False):
+
+    """ Get the number of questions already added to the local database for the given category
+
+        :param category_id: False or category id number
+        :return: dict of question counts - global and category if category_id provided
+    """
+
+    counts = local_counts()
+
+    questions = {
+       'global': sum(sum(levels.values()) for levels in counts.values())
+    }
+
+    if not category_id:
+        return questions
+
+    questions['category'] = sum(counts.get(category_id, {}).values())
+
+    return questions
+
+
+def question_breakdown(category_id = False):
+
+    """ Get category question counts from API
+
+        :param category_id: Global count if False, else count for given category
+        :return: dict question counts by category id and additional entry for overall question count
+                 Plus, if category_id provided, dict with category id and question counts for each difficulty level
+    """
+
+    req_details = {
+        'callback': extract_counts,
+        'endpoint': 'api_count_global.php'
+    }
+
+    questions = {
+        'global': cached_lookup(req_details)
+    }
+
+    if not category_id:
+        return questions
+
+    req_details = {
+        'callback': lambda api_data: api_data,
+        'endpoint': 'api_count.php',
+        'parameters': {
+            'category': category_id
+        }
+    }
+
+    # Return a single dict with category number and question counts for each difficulty level
+    breakdown = cached_lookup(req_details)
+    breakdown['category_question_count']['id'] = breakdown['category_id']
+    questions['category'] = breakdown['category_question_count']
+
+    return questions
+
+
+def level_counts(category_id):
+
+    """ Get the number of questions added to the local database for each difficulty level
+
+        :param category_id: Category to query
+        :return: dict of question counts by level
+    """
+
+    counts = {
+        'easy': 0,
+        'medium': 0,
+        'hard': 0
+    }
+
+    counts.update(local_counts().get(category_id, {}))
+
+    return counts
+
+
+def local_counts():
+
+    """ Get the local count index, building it with a single query the first time it's needed
+
+        :return: dict of question counts by category id and difficulty level eg {9: {'easy': 100, ...}, ...}
+    """
+
+    global count_index
+
+    if count_index is None:
+        rows = db_transaction(lambda cursor: fetch_all(cursor, "SELECT category_id, difficulty, COUNT(*) FROM questions GROUP BY category_id, difficulty"))
+
+        if rows is None:
+            # Query failed - don't cache an empty index
+            return {}
+
+        count_index = {}
+
+        for category_id, difficulty, count in rows:
+            count_index.setdefault(category_id, {})[difficulty] = count
+
+    return count_index
+
+
+def sync_journal():
+
+    """ Get the sync journal, loading it the first time it's needed
+
+        :return: dict of journal entries keyed by (category id, difficulty level)
+    """
+
+    global journal
+
+    if journal is None:
+        rows = db_transaction(lambda cursor: fetch_all(cursor, "SELECT category_id, difficulty, token, target, pages_fetched, questions_fetched, rows_committed, completed FROM sync_journal"))
+
+        if rows is None:
+            # Query failed - don't cache an empty journal
+            return {}
+
+        journal = {}
+
+        for category_id, level, token, target, pages_fetched, questions_fetched, rows_committed, completed in rows:
+            journal[(category_id, level)] = {
+                'token': token,
+                'target': target,
+                'pages_fetched': pages_fetched,
+                'questions_fetched': questions_fetched,
+                'rows_committed': rows_committed,
+                'completed': bool(completed)
+            }
+
+    return journal
+
+
+def journal_level(category_id, level, target, token):
+
+    """ Start a journal entry for a level, or pick up the existing one if it was started with the same token
+
+        :param category_id: Category to sync
+        :param level: Difficulty level or 'all'
+        :param target: Number of questions available for the level
+        :param token: Session token the questions will be requested with
+        :return: Journal entry
+    """
+
+    entries = sync_journal()
+    entry = entries.get((category_id, level))
+
+    if entry is None or entry['token'] != token:
+        # Progress made with another token doesn't count - the API will resend those questions
+        entry = {
+            'token': token,
+            'target': target,
+            'pages_fetched': 0,
+            'questions_fetched': 0,
+            'rows_committed': 0,
+            'completed': False
+        }
+    elif entry['target'] != target:
+        # More questions have become available since the level was last synchronised
+        entry = dict(entry, target=target, completed=entry['questions_fetched'] >= target)
+    else:
+        return entry
+
+    db_query([{
+        'query': storage_backend().upsert_sql('sync_journal', ['category_id', 'difficulty', 'token', 'target', 'pages_fetched', 'questions_fetched', 'rows_committed', 'completed'], ['category_id', 'difficulty']),
+        'values': (category_id, level, token, target, entry['pages_fetched'], entry['questions_fetched'], entry['rows_committed'], entry['completed'])
+    }])
+
+    entries[(category_id, level)] = entry
+
+    return entry
+
+
+def record_page(cursor, category_id, level, token, fetched, committed, ended = False):
+
+    """ Checkpoint a level's progress in the sync journal - run in the same transaction as the page it records
+
+        :param cursor: Cursor for the open transaction
+        :param category_id: Category the page was requested for
+        :param level: Difficulty level or 'all'
+        :param token: Session token the page was requested with
+        :param fetched: Number of questions returned by the API
+        :param committed: Number of questions added to the database
+        :param ended: True if the API has no more questions for the level
+        :return: Updated journal entry - store it in the journal once the transaction commits
+    """
+
+    entry = dict(sync_journal()[(category_id, level)])
+
+    if entry['token'] != token:
+        # The token was replaced part way through the level - questions fetched with the old one don't count
+        entry.update(token=token, pages_fetched=0, questions_fetched=0, rows_committed=0)
+
+    entry['pages_fetched'] += 1
+    entry['questions_fetched'] += fetched
+    entry['rows_committed'] += committed
+    entry['completed'] = ended or entry['questions_fetched'] >= entry['target']
+
+    cursor.execute(
+        "UPDATE sync_journal SET token = %s, pages_fetched = %s, questions_fetched = %s, rows_committed = %s, completed = %s WHERE category_id = %s AND difficulty = %s",
+        (entry['token'], entry['pages_fetched'], entry['questions_fetched'], entry['rows_committed'], entry['completed'], category_id, level)
+    )
+
+    return entry
+
+
+def known_fingerprints():
+
+    """ Get the fingerprints of all questions in the local database, loading them the first time they're needed
+
+        :return: dict of content fingerprints keyed by question fingerprint
+    """
+
+    global fingerprints
+
+    if fingerprints is None:
+        loaded = db_transaction(load_fingerprints)
+
+        if loaded is None:
+            # Query failed - don't cache an empty index
+            return {}
+
+        fingerprints = loaded
+
+    return fingerprints
+
+
+def load_fingerprints(cursor):
+
+    """ Fingerprint any questions added before fingerprints were stored, then read all fingerprints - helper for known_fingerprints()
+
+        :param cursor: Cursor for the open transaction
+        :return: dict of content fingerprints keyed by question fingerprint
+    """
+
+    rows = fetch_all(cursor, "SELECT question_hash FROM questions WHERE question_hash IS NOT NULL")
+    backfilled = {bytes(row[0]) for row in rows}
+    updates = []
+
+    for question_id, question_text in fetch_all(cursor, "SELECT id, question_text FROM questions WHERE question_hash IS NULL"):
+        fingerprint = question_fingerprint(question_text)
+
+        # Near-identical questions stored before fingerprinting can share a fingerprint - the first keeps it
+        if not fingerprint in backfilled:
+            backfilled.add(fingerprint)
+            updates.append((fingerprint, question_id))
+
+    if updates:
+        print(f"\nFingerprinting {len(updates)} stored questions\n")
+        cursor.executemany("UPDATE questions SET question_hash = %s WHERE id = %s", updates)
+
+    stored = {}
+
+    for question_id, question_text, question_type, difficulty, answer, correct in fetch_all(cursor, "SELECT questions.id, questions.question_text, questions.type, questions.difficulty, answers.answer, answers.correct FROM questions JOIN answers ON answers.question_id = questions.id WHERE questions.content_hash IS NULL"):
+        stored.setdefault(question_id, (question_text, question_type, difficulty, []))[3].append((answer, correct))
+
+    if stored:
+        print(f"\nFingerprinting the content of {len(stored)} stored questions\n")
+        cursor.executemany("UPDATE questions SET content_hash = %s WHERE id = %s", [(stored_content_fingerprint(*details), question_id) for question_id, details in stored.items()])
+
+    return {bytes(fingerprint): content_hash and bytes(content_hash) for fingerprint, content_hash in fetch_all(cursor, "SELECT question_hash, content_hash FROM questions WHERE question_hash IS NOT NULL")}
+
+
+def count_added(category_id, added):
 
-    """ Add a new category to the local database if given category does not exist
+    """ Update the local count index with newly added questions
 
-        :param category_id: the id number for the new category
-        :return: False or the id number for the new category
+        :param category_id: Category the questions were added to
+        :param added: List of the Question records that were added
     """
-    if not category_id in trivia_categories:
-        # Category doesn't exist - we're done
-        return False
 
-    cat_name =  trivia_categories[category_id]
+    levels = local_counts().setdefault(category_id, {})
 
-    db_query([{
-        # Make sure category exists
-        'query': "INSERT INTO categories (id, category) VALUES (%s, %s) ON DUPLICATE KEY UPDATE id=id", 
-        'values': (category_id, cat_name)
-    }])
+    for question in added:
+        levels[question.difficulty] = levels.get(question.difficulty, 0) + 1
 
-    return category_id
 
+def refresh_question_sequence():
 
-def next_category(category_id = MIN_CAT_NUM):
+    """ Give questions added since the last refresh a position in the random selection index
 
-    """ Get dictionary for the given category
+        Questions are numbered from 0 within their category/difficulty/type bucket and sequence_buckets holds the size
+        of each bucket, so a reader can pick N random positions below the size and look them up by primary key
 
-        :return: False or dict with category id and question counts for each difficulty level 
+        :return: Number of questions indexed or None if the refresh failed
     """
 
-    global trivia_categories
+    db = storage_backend()
 
-    if category_id and category_id in trivia_categories.keys():
+    def refresh(cursor):
+        # Workers finishing together would otherwise hand out the same positions
+        db.serialise(cursor, 'sequence_buckets')
 
-        category = category_status(category_id)
+        new_rows = fetch_all(cursor, "SELECT questions.id, questions.category_id, questions.difficulty, questions.type FROM questions LEFT JOIN question_sequence ON question_sequence.question_id = questions.id WHERE question_sequence.question_id IS NULL ORDER BY questions.id")
 
-        if category['completed']:
-            print(f"Category {category_id}: no new questions available")
-            return next_category(get_category(category_id + 1))
+        if not new_rows:
+            return 0
 
-        print(f"\nCategory {category_id}: new questions available. Processing...\n")
-        return category['next']
+        sizes = {(category_id, difficulty, question_type): size for category_id, difficulty, question_type, size in fetch_all(cursor, "SELECT category_id, difficulty, type, size FROM sequence_buckets")}
+        positions = []
 
-    return False
+        for question_id, category_id, difficulty, question_type in new_rows:
+            bucket = (category_id, difficulty, question_type)
+            position = sizes.get(bucket, 0)
+            sizes[bucket] = position + 1
+            positions.append(bucket + (position, question_id))
 
+        cursor.executemany("INSERT INTO question_sequence (category_id, difficulty, type, position, question_id) VALUES (%s, %s, %s, %s, %s)", positions)
 
-def category_status(category_id = False):
+        grown = {row[:3] for row in positions}
+        cursor.executemany(db.upsert_sql('sequence_buckets', ['category_id', 'difficulty', 'type', 'size'], ['category_id', 'difficulty', 'type']), [bucket + (sizes[bucket],) for bucket in sorted(grown)])
 
-    """ Get category status - helper for next_category()
+        return len(positions)
 
-        :return: dict containing
-            - 'completed' boolean
-            - 'next' dict with question breakdown for next category to process
-    """
-    
-    if not category_id:
-        category_id = current_category()
+    return db_transaction(refresh)
 
-    source_questions = question_breakdown(category_id)
-    category = source_questions['category']
-    category_questions_done = questions_done(category_id)['category']
 
-    return {
-        'completed': category_questions_done == category['total_question_count'],
-        'next': category
-    }
+def verify_database():
 
+    """ Reconcile the local database with Open Trivia using the global count and a few aggregate queries, repairing what
+        can be repaired in place
 
-def current_category():
+        Questions with no answers, or the wrong number, are removed so the next sync fetches them again, and the journal
+        is cleared for every category that doesn't match Open Trivia's count, so the next sync plans it afresh
 
-    """ Return id number of current category or None
+        :return: dict of findings or None if the counts or the database couldn't be checked
     """
-    # Get highest numbered category from local database
-    curr_cat_id = db_query(["SELECT MAX(id) FROM categories"])[0]
 
-    return curr_cat_id
+    # Asked for directly - a cached count could be out of date
+    global_counts = api_request({'callback': extract_counts, 'endpoint': 'api_count_global.php'}, False)
 
+    if global_counts is None:
+        print("\nError: unable to get question counts from Open Trivia\n")
+        return
 
-def process_category(to_do):
+    db = storage_backend()
+    upstream = {category_id: count for category_id, count in global_counts.items() if category_id != 'overall'}
 
-    """ Add outstanding questions for this category to local database
+    def verify(cursor):
+        findings = {}
 
-        :param to_do: Dictionary with category number, total question count and levels dictionary eg {'easy': 100, ...}
-    """
+        stored_categories = {row[0] for row in fetch_all(cursor, "SELECT id FROM categories")}
+        question_categories = {row[0] for row in fetch_all(cursor, "SELECT DISTINCT category_id FROM questions")}
+        missing = sorted((question_categories | set(trivia_categories)) - stored_categories)
 
-    category = to_do['category']
+        # Questions whose answers a partial write never stored, and questions with too many or too few answers
+        unanswered = fetch_all(cursor, "SELECT questions.id, questions.category_id, questions.difficulty FROM questions LEFT JOIN answers ON answers.question_id = questions.id WHERE answers.question_id IS NULL")
+        misanswered = fetch_all(cursor, "SELECT questions.id, questions.category_id, questions.difficulty FROM questions JOIN answers ON answers.question_id = questions.id GROUP BY questions.id, questions.category_id, questions.difficulty, questions.type HAVING (questions.type = 'multiple' AND (COUNT(*) <> 4 OR SUM(answers.correct) <> 1)) OR (questions.type = 'boolean' AND COUNT(*) <> 1)")
 
-    print(f"Updating category {category}\n")
+        findings['missing_categories'] = [category_id for category_id in missing if category_id in trivia_categories]
+        findings['unknown_categories'] = [category_id for category_id in missing if not category_id in trivia_categories]
+        findings['unanswered'] = len(unanswered)
+        findings['misanswered'] = len(misanswered)
 
-    levels_to_do = to_do['levels']
+        if findings['missing_categories']:
+            cursor.execute(db.insert_ignore_sql('categories', ['id', 'category'], len(findings['missing_categories'])), [value for category_id in findings['missing_categories'] for value in (category_id, trivia_categories[category_id])])
 
-    # levels_to_do is eg {'easy': 116}
-    if not levels_to_do:
-        # Add all questions for given category to database
-        process_level(category, {'level': "all", 'count': to_do['total']})
-    else:
-        for level, count in levels_to_do.items():
-            # Add all questions for given levels to database
-            process_level(category, {'level': level, 'count': count})
+        broken = unanswered + misanswered
 
+        if broken:
+            # Close the gaps the questions leave in the random selection index - their answers go with them
+            remove_from_sequence(cursor, [row[0] for row in broken])
+            cursor.execute(f"DELETE FROM questions WHERE id IN ({', '.join(['%s'] * len(broken))})", [row[0] for row in broken])
+            record_changes(cursor, [tuple(row) + ('delete',) for row in broken])
 
-def process_level(category_id, to_do):
+        # Counted after the repairs, so removed questions show up as drift to be fetched again
+        levels = {}
 
-    """ Add questions to local database - restrict to difficulty level if provided
+        for category_id, difficulty, count in fetch_all(cursor, "SELECT category_id, difficulty, COUNT(*) FROM questions GROUP BY category_id, difficulty"):
+            levels.setdefault(category_id, {})[difficulty] = count
 
-        :param category_id: Id number of current category
-        :param to_do: Dictionary with difficulty level and question count eg {'level': 'all', 'count': 100'}
-    """
-    req_details = {
-        'callback': process_questions,
-        'endpoint': 'api.php',
-        'parameters': {
-            'category': category_id,
-            'amount': MAX_QUESTIONS
-        }
-    }
+        findings['drift'] = [
+            {
+                'category': category_id,
+                'local': sum(levels.get(category_id, {}).values()),
+                'upstream': upstream.get(category_id, 0),
+                'levels': levels.get(category_id, {})
+            }
+            for category_id in sorted(set(upstream) | set(levels))
+            if sum(levels.get(category_id, {}).values()) != upstream.get(category_id, 0)
+        ]
 
-    difficulty_level = to_do['level']
+        drifted = [entry['category'] for entry in findings['drift']]
 
-    if not difficulty_level == "all":
-        req_details['parameters']['difficulty'] = difficulty_level
+        if drifted:
+            cursor.execute(f"DELETE FROM sync_journal WHERE category_id IN ({', '.join(['%s'] * len(drifted))})", drifted)
 
-    total = to_do['count']
-    
-    for i in range(MAX_QUESTIONS, total + 1, MAX_QUESTIONS):
-        # API will return unique questions because we're using a token
-        api_request(req_details)
+        return findings
 
-    remaining = total % MAX_QUESTIONS
+    findings = db_transaction(verify)
 
-    if remaining:
-         # Add any stragglers
-        req_details['parameters']['amount'] = remaining
-        api_request(req_details)
+    if findings is not None:
+        metrics.increment('questions_removed_total', findings['unanswered'] + findings['misanswered'])
 
+    return findings
 
-def process_questions(questions, req_details):
 
-    """ Add the given questions to the local database
+def remove_from_sequence(cursor, question_ids):
 
-        :param questions: A list of question dictionaries, each containing the details of a single question
-        :param: req_details: The url segments used for the api request
-    """    
-    category_id = req_details[ 'parameters']['category']
+    """ Take questions out of the random selection index, keeping each bucket dense
 
-    if len(questions):
-        category_name = questions[0]['category']
-
-        db_query([{
-            # Make sure category exists
-            'query': "INSERT INTO categories (id, category) VALUES (%s, %s) ON DUPLICATE KEY UPDATE id=id", 
-            'values': (category_id, category_name)
-        }])
-
-        db_queries_answers = []
-        previous_question_id = None
-
-        for question_details in questions:
-            # Prepare requests for all questions
-            db_queries_questions = [{
-                'query': "INSERT INTO questions (category_id, type, difficulty, question_text) VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE id=id", 
-                'values': (category_id, question_details['type'], question_details['difficulty'], question_details['question'])
-            }]
-
-            # Add question to database
-            last_insert_id = db_query(db_queries_questions, True)
-
-            # Check that question was not skipped as a duplicate before inserting answers
-            if last_insert_id > 0 and (previous_question_id is None or previous_question_id != last_insert_id):
-
-                if question_details['type'] == 'boolean':
-                    db_queries_answers.append({
-                        'query': "INSERT INTO answers (question_id, correct) VALUES (%s, %s)", 
-                        'values': (last_insert_id, question_details['correct_answer'] == "True")
-                    })
-                else:
-                    for incorrect_answer in question_details['incorrect_answers']:
-                        db_queries_answers.append({
-                            'query': "INSERT INTO answers (question_id, answer, correct) VALUES (%s, %s, 0)", 
-                            'values': (last_insert_id, incorrect_answer)
-                        })
-                    # Add correct answer
-                    db_queries_answers.append({
-                            'query': "INSERT INTO answers (question_id, answer, correct) VALUES (%s, %s, 1)", 
-                            'values': (last_insert_id, question_details['correct_answer'])
-                        })
-
-                previous_question_id = last_insert_id
-        
-        if len(db_queries_answers):
-            db_query(db_queries_answers)
+        The question in the last position of the bucket moves into the position left behind and the bucket shrinks by one
 
-    else:
-        # No questions were provided - print a warning so it can be looked into if necessary
-        print(f"\nWARNING: No questions provided to process_questions() for category {category_id}\n")
+        :param cursor: Cursor for the open transaction
+        :param question_ids: Id numbers of the questions to remove
+    """
 
+    # Positions are handed out and moved under the same lock as refresh_question_sequence()
+    storage_backend().serialise(cursor, 'sequence_buckets')
 
-def questions_done(category_id = False):
+    removed = fetch_all(cursor, f"SELECT category_id, difficulty, type, position FROM question_sequence WHERE question_id IN ({', '.join(['%s'] * len(question_ids))})", question_ids)
 
-    """ Get the number of questions already added to the local database for the given category
+    if not removed:
+        return
 
-        :param category_id: False or category id number
-        :return: dict of question counts - global and category if category_id provided
-    """
+    sizes = {(category_id, difficulty, question_type): size for category_id, difficulty, question_type, size in fetch_all(cursor, "SELECT category_id, difficulty, type, size FROM sequence_buckets")}
 
-    query_details = ["SELECT COUNT(*) FROM questions"]
+    # Working down from the highest position means the last position never holds a question still to be removed
+    for category_id, difficulty, question_type, position in sorted(removed, key=lambda row: -row[3]):
+        bucket = (category_id, difficulty, question_type)
+        last = sizes[bucket] - 1
 
-    questions = {
-       'global': db_query(query_details)[0] 
-    }
+        cursor.execute("DELETE FROM question_sequence WHERE category_id = %s AND difficulty = %s AND type = %s AND position = %s", bucket + (position,))
 
-    if not category_id:
-        return questions
+        if position != last:
+            cursor.execute("UPDATE question_sequence SET position = %s WHERE category_id = %s AND difficulty = %s AND type = %s AND position = %s", (position,) + bucket + (last,))
 
-    query_details = [{
-        'query': "SELECT COUNT(*) FROM questions WHERE category_id = %s", 
-        'values': (category_id,)
-    }]
+        sizes[bucket] = last
 
-    questions['category'] = db_query(query_details)[0]
+    shrunk = sorted({tuple(row[:3]) for row in removed})
+    cursor.executemany(storage_backend().upsert_sql('sequence_buckets', ['category_id', 'difficulty', 'type', 'size'], ['category_id', 'difficulty', 'type']), [bucket + (sizes[bucket],) for bucket in shrunk])
 
-    return questions
 
+def fetch_all(cursor, query, values = ()):
 
-def question_breakdown(category_id = False):
+    """ Run a query on the given cursor and return every row
 
-    """ Get category question counts from API
+        :param cursor: Cursor for an open transaction
+        :param query: SQL query string
+        :param values: Values for any placeholders in the query
+        :return: List of row tuples
+    """
 
-        :param category_id: Global count if False, else count for given category
-        :return: dict question counts by category id and additional entry for overall question count
-                 Plus, if category_id provided, dict with category id and question counts for each difficulty level
+    cursor.execute(query, values)
+    return cursor.fetchall()
+
+
+def extract_counts(api_data):
+
+    """ Filter api_data to include only verified question counts
+
+        :param api_data: Data returned by API
+        :Return: Dictionary of verified question counts
     """
 
-    req_details = {
-        'callback': extract_counts,
-        'endpoint': 'api_count_global.php'
+    extracted_counts = {
+        'overall': api_data['overall']['total_num_of_verified_questions']
     }
 
-    questions = {
-        'global': api_request(req_details, False)
-    }
+    for cat_key in api_data['categories'].keys():
+        extracted_counts[int(cat_key)] = api_data['categories'][cat_key]['total_num_of_verified_questions']
 
-    if not category_id:
-        return questions
+    return extracted_counts
 
-    req_details = {
-        'callback': lambda api_data: api_data,
-        'endpoint': 'api_count.php',
-        'parameters': {
-            'category': category_id
-        }
-    }
 
-    # Return a single dict with category number and question counts for each difficulty level
-    breakdown = api_request(req_details, False)
-    breakdown['category_question_count']['id'] = breakdown['category_id']
-    questions['category'] = breakdown['category_question_count']
+def cached_lookup(req_details):
 
-    return questions
+    """ Make an api lookup, reusing the response if it was fetched earlier in the run or is fresh in the disk cache
 
+        :param req_details: Dictionary containing the url fragments and the callback to process the response
+        :return: Processed data or None
+    """
 
-def level_counts(category_id):
+    global lookup_cache
 
-    """ Get the number of questions added to the local database for each difficulty level
+    if lookup_cache is None:
+        lookup_cache = load_lookup_cache()
 
-        :param category_id: Category to query
-        :return: dict of question counts by level
+    key = req_details['endpoint']
+
+    if 'parameters' in req_details:
+        key += "?" + "&".join(f"{name}={val}" for name, val in sorted(req_details['parameters'].items()))
+
+    if not key in lookup_cache:
+        api_data = api_request({
+            'callback': lambda api_data: api_data,
+            'endpoint': req_details['endpoint'],
+            'parameters': req_details.get('parameters', {})
+        }, False)
+
+        if api_data is None:
+            return
+
+        lookup_cache[key] = {
+            'fetched': time.time(),
+            'data': api_data
+        }
+        save_lookup_cache()
+
+    # Callbacks get their own copy so they can't alter the cached response
+    return req_details['callback'](copy.deepcopy(lookup_cache[key]['data']))
+
+
+def load_lookup_cache():
+
+    """ Read lookup responses saved by previous runs - helper for cached_lookup()
+
+        :return: dict of responses that are still within the ttl set in appconfig.ini, keyed by request
     """
 
-    counts = {
-        'easy': 0,
-        'medium': 0,
-        'hard': 0
-    }
+    cache_path = config.get('cacheconfig', 'path', fallback=None)
 
-    for level in counts:
-        query_details = [{
-            'query': "SELECT COUNT(*) FROM questions WHERE category_id = %s AND difficulty = %s", 
-            'values': (category_id, level)
-        }]
+    if not cache_path or not os.path.exists(cache_path):
+        return {}
 
-        counts[level] = db_query(query_details)[0]
+    ttl = config.getfloat('cacheconfig', 'ttl', fallback=DEFAULT_CACHE_TTL)
+    now = time.time()
 
-    return counts
+    try:
+        with open(cache_path) as cache_file:
+            saved = json.load(cache_file)
+    except (OSError, ValueError):
+        # Unreadable cache - we'll start a new one
+        return {}
 
+    return {key: entry for key, entry in saved.items() if now - entry['fetched'] < ttl}
 
-def extract_counts(api_data):
 
-    """ Filter api_data to include only verified question counts
+def save_lookup_cache():
 
-        :param api_data: Data returned by API
-        :Return: Dictionary of verified question counts
+    """ Write lookup responses to the disk cache if one is configured - helper for cached_lookup()
     """
 
-    extracted_counts = {
-        'overall': api_data['overall']['total_num_of_verified_questions']
-    }
+    cache_path = config.get('cacheconfig', 'path', fallback=None)
 
-    for cat_key in api_data['categories'].keys():
-        extracted_counts[int(cat_key)] = api_data['categories'][cat_key]['total_num_of_verified_questions']
+    if not cache_path:
+        return
 
-    return extracted_counts
+    # An interrupted write can't leave a corrupt cache
+    write_atomically(cache_path, lambda cache_file: json.dump(lookup_cache, cache_file))
 
 
 def new_token():
@@ -353,27 +1389,76 @@ def new_token():
     return api_request(req_details, False)
 
 
+def stored_token():
+
+    """ Get the session token without contacting the API, eg to plan a run without changing anything
+
+        :return: Session cookie string or None
+    """
+
+    with token_store['lock']:
+        if not token_store['loaded']:
+            load_token()
+
+        return token_store['token'] or None
+
+
 def session_token(expired = False):
 
     """ Retrieve a session token
 
-        :param expired: Do not read from config - get new from API
+        :param expired: Do not use the stored token - get new from API
         :return: Session cookie string
     """
 
-    config.read('appconfig.ini')
-    token = config.get('tokenconfig', 'api_token')
+    # Hold the lock while refreshing so concurrent callers wait for the new token rather than requesting their own
+    with token_store['lock']:
+        claim_token_file()
+
+        if not token_store['loaded']:
+            load_token()
 
-    if expired or (not token) or len(token) == 0:
-        # Token rejected or not set - request new one from api
-        token = new_token()
+        token = token_store['token']
+        issued = token_store['issued']
+
+        # The API drops tokens after 6 hours - replace ours before that happens rather than waiting for response code 3
+        stale = issued is not None and time.time() - issued > TOKEN_LIFETIME - TOKEN_REFRESH_MARGIN
+
+        if expired or stale or (not token) or len(token) == 0:
+            # Token rejected, about to expire or not set - request new one from api
+            token = new_token()
 
     return token
 
 
+def load_token():
+
+    """ Populate the token store from the token file - helper for session_token()
+
+        Falls back to the api_token entry in appconfig.ini if the token file has not been written yet
+    """
+
+    token_config = configparser.ConfigParser()
+    token_config.read(token_path())
+
+    if 'tokenconfig' in token_config:
+        token_store['token'] = token_config.get('tokenconfig', 'api_token', fallback="")
+        token_store['issued'] = token_config.getfloat('tokenconfig', 'issued', fallback=None)
+    elif worker_id is None:
+        # When this token was issued is unknown - rely on response code 3 to tell us it has expired
+        token_store['token'] = config.get('tokenconfig', 'api_token', fallback="")
+        token_store['issued'] = None
+    else:
+        # Named workers don't share the token in appconfig.ini - each requests its own
+        token_store['token'] = ""
+        token_store['issued'] = None
+
+    token_store['loaded'] = True
+
+
 def set_token(token, req_details):
 
-    """ Store new session token in config file
+    """ Store new session token and save it to the token file
 
         :param token: String returned by API
         :return: the token
@@ -383,13 +1468,72 @@ def set_token(token, req_details):
         print("\nError: expected alphanumeric token\n")
         sys.exit(1)
 
-    config.set('tokenconfig', 'api_token', token)
-    with open('appconfig.ini', 'w') as configfile:
-        config.write(configfile)
+    with token_store['lock']:
+        claim_token_file()
+
+        if token == token_store['token']:
+            # Nothing has changed - no need to touch the file
+            return token
+
+        token_store['token'] = token
+        token_store['issued'] = time.time()
+        token_store['loaded'] = True
+
+        token_config = configparser.ConfigParser()
+        token_config['tokenconfig'] = {
+            'api_token': token,
+            'issued': str(token_store['issued'])
+        }
+
+        # The stored token is never left half written
+        write_atomically(token_path(), token_config.write)
 
     return token
 
 
+def token_path():
+
+    """ :return: Path of the token file - named workers each keep their own
+    """
+
+    path = config.get('tokenconfig', 'token_file', fallback=DEFAULT_TOKEN_FILE)
+
+    if worker_id is None:
+        return path
+
+    base, extension = os.path.splitext(path)
+    return f"{base}-{worker_id}{extension}"
+
+
+def claim_token_file():
+
+    """ Make sure no other process is using this worker's token file, so each worker has a session token of its own
+
+        Workers without a name share the default token file, so only one of them can run at a time - exit if another
+        already holds it
+    """
+
+    global token_lock
+
+    if token_lock is not None:
+        return
+
+    try:
+        import fcntl
+    except ImportError:
+        # Not available on Windows - nothing stops workers sharing a token there
+        return
+
+    token_lock = open(token_path() + ".lock", 'w')
+
+    try:
+        # Held until the process exits
+        fcntl.flock(token_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        print(f"\nError: another worker is using {token_path()} - give each worker its own name and session token with --worker\n")
+        sys.exit(1)
+
+
 def reset_session_token(token):
 
     """ Retrieve a new session cookie from the API
@@ -418,37 +1562,82 @@ def api_request(req_details, use_token = True):
         :return: Processed data
     """
 
-    req_url = "https://opentdb.com/"
-    pre = ""
+    req_url = config.get('apiconfig', 'base_url', fallback=DEFAULT_API_URL)
+    parameters = dict(req_details.get('parameters', {}))
     
     # Assemble API request
     if 'endpoint' in req_details:
         req_url += req_details['endpoint']
 
-    if 'parameters' in req_details:
-        parameters = req_details['parameters']
-        pre = "?"
+    if use_token:
+        # Add the token to ensure the api returns no duplicate questions
+        parameters['token'] = session_token()
 
-        for key, val in parameters.items():
-            req_url += f"{pre}{key}={val}"
-            pre = "&"
+        # Noted so the page is journalled against the token it was actually requested with
+        req_details['token'] = parameters['token']
 
-    if use_token:
-        # Append the token to ensure the api returns no duplicate questions
-        req_url += f"{pre}token={session_token()}"
+    if parameters:
+        req_url += "?" + urlencode(parameters)
 
-    # Make the call
-    try:
-        headers = {
-          'Cookie': "PHPSESSID=1b01789fb2d1898c5d3358944fec0590"
-        }
-        response = requests.get(req_url, headers=headers)
-        response.raise_for_status()
-    except requests.RequestException:
-        return
+    timeout = (
+        config.getfloat('apiconfig', 'connect_timeout', fallback=DEFAULT_CONNECT_TIMEOUT),
+        config.getfloat('apiconfig', 'read_timeout', fallback=DEFAULT_READ_TIMEOUT)
+    )
+    attempt = 0
+
+    while True:
+        # Wait our turn so we stay within the API rate limit
+        wait_for_request_slot()
+
+        # Make the call
+        try:
+            metrics.increment('api_requests_total', endpoint=req_details.get('endpoint'))
+
+            with metrics.timed('api_request_seconds', endpoint=req_details.get('endpoint')):
+                response = api_session().get(req_url, timeout=timeout)
+
+            if response.status_code == 429 or response.status_code >= 500:
+                # Throttled or server trouble - worth another try
+                retry_after = response.headers.get('Retry-After')
+                backoff(attempt, f"HTTP {response.status_code}", retry_after)
+                attempt += 1
+                continue
+
+            response.raise_for_status()
+
+            if response.status_code == 204:
+                return
+
+        except (requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema, requests.exceptions.InvalidURL) as e:
+            # No point retrying a mistyped base_url
+            print(f"\nError: invalid API URL {req_url} - check base_url in the [apiconfig] section\n{e}\n")
+            sys.exit(1)
 
-    if response.status_code != 204:
-        return process_response(req_details, response.json(), req_url)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            # Network hiccup or timeout
+            backoff(attempt, type(e).__name__)
+            attempt += 1
+            continue
+
+        except requests.RequestException:
+            return
+
+        try:
+            api_response = response.json()
+
+        except ValueError:
+            # Truncated or malformed response body
+            backoff(attempt, "Malformed response")
+            attempt += 1
+            continue
+
+        if isinstance(api_response, dict) and api_response.get('response_code') == RATE_LIMIT_RESPONSE_CODE:
+            # Response code 5: too many requests - back off and try again
+            backoff(attempt, f"Response code {RATE_LIMIT_RESPONSE_CODE}")
+            attempt += 1
+            continue
+
+        return process_response(req_details, api_response, req_url)
 
 
 def process_response(req_details, api_response, req_url):
@@ -499,7 +1688,9 @@ def process_response(req_details, api_response, req_url):
         elif response_code == 4:
             # We've processed all questions in the current category
             print("\nNotification: (Response code 4): All requested questions have been returned for the current token. Run the app without the -t flag to use a new token\n")
-            return
+
+            # An empty page rather than None, which means the request failed
+            return []
             
         else:
             # Response code does not match expected values - assume question data is unviable
@@ -510,31 +1701,143 @@ def process_response(req_details, api_response, req_url):
         return
 
 
+def api_session():
+
+    """ Get the shared HTTP session, creating it on first use
+
+        The session keeps connections to the API alive between requests so each call doesn't pay for a new TLS handshake
+
+        :return: requests.Session
+    """
+
+    global http_session
+
+    if http_session is None:
+        pool_size = config.getint('apiconfig', 'pool_size', fallback=DEFAULT_HTTP_POOL_SIZE)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+
+        http_session = requests.Session()
+        http_session.mount('https://', adapter)
+        http_session.mount('http://', adapter)
+        http_session.headers.update({
+            'Accept-Encoding': "gzip, deflate",
+            'Connection': "keep-alive"
+        })
+
+        if 'apiheaders' in config:
+            # Any extra headers listed in appconfig.ini
+            http_session.headers.update(dict(config['apiheaders']))
+
+    return http_session
+
+
+def wait_for_request_slot():
+
+    """ Block until the request rate set in appconfig.ini allows another API call - helper for api_request()
+
+        Uses a token bucket shared by all threads. Setting the rate to 0 disables the limit.
+    """
+
+    rate = config.getfloat('apiconfig', 'rate', fallback=DEFAULT_API_RATE)
+
+    if rate <= 0:
+        return
+
+    burst = config.getfloat('apiconfig', 'burst', fallback=DEFAULT_API_BURST)
+
+    with scheduler['lock']:
+        now = time.monotonic()
+
+        if scheduler['updated'] is None:
+            tokens = burst
+        else:
+            # Refill for the time elapsed since the last request
+            tokens = min(burst, scheduler['tokens'] + (now - scheduler['updated']) * rate)
+
+        wait = 0 if tokens >= 1 else (1 - tokens) / rate
+
+        # Take our token now - it may go negative, which reserves a slot for any thread that calls while we wait
+        scheduler['tokens'] = tokens - 1
+        scheduler['updated'] = now
+        scheduler['throttled'] += wait
+
+    if wait:
+        metrics.increment('api_throttled_total')
+        metrics.observe('api_throttle_seconds', wait)
+        time.sleep(wait)
+
+
+def backoff(attempt, reason, retry_after = None):
+
+    """ Sleep before retrying a failed API call - helper for api_request()
+
+        :param attempt: Number of retries already made for this request
+        :param reason: Description of the failure for the log
+        :param retry_after: Value of the Retry-After header, if provided
+    """
+
+    max_retries = config.getint('apiconfig', 'max_retries', fallback=DEFAULT_MAX_RETRIES)
+
+    with scheduler['lock']:
+        give_up = attempt >= max_retries or scheduler['retries'] >= config.getint('apiconfig', 'retry_budget', fallback=DEFAULT_RETRY_BUDGET)
+        if not give_up:
+            scheduler['retries'] += 1
+
+    if give_up:
+        print(f"\nError ({reason}): Open Trivia API request failed and no retries remain - made {scheduler['retries']} retries this run\n")
+        sys.exit(1)
+
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        # Exponential backoff with jitter so concurrent callers don't retry in lockstep
+        base = config.getfloat('apiconfig', 'backoff_base', fallback=DEFAULT_BACKOFF_BASE)
+        ceiling = config.getfloat('apiconfig', 'backoff_max', fallback=DEFAULT_BACKOFF_MAX)
+        delay = random.uniform(0.5, 1) * min(ceiling, base * 2 ** attempt)
+
+    print(f"\nNotification ({reason}): retrying Open Trivia API request in {delay:.1f}s\n")
+    metrics.increment('api_retries_total', reason=reason)
+
+    with scheduler['lock']:
+        scheduler['backed_off'] += delay
+
+    time.sleep(delay)
+
+
+def throttle_report():
+
+    """ Summarise time spent waiting on the API this run
+
+        :return: dict with seconds spent throttled by the rate limit and backing off, and the number of retries
+    """
+
+    with scheduler['lock']:
+        return {
+            'throttled': scheduler['throttled'],
+            'backed_off': scheduler['backed_off'],
+            'retries': scheduler['retries']
+        }
+
+
 def db_query(db_queries, questions = False):
 
-    """ Execute the provided list of MySQL queries
+    """ Execute the provided list of SQL queries, committing once after the last
 
         :param db_queries: List of parameterised request dictionaries/SQL query strings
         :param questions: True when adding questions to database
-        :return: ID of added row if questions parameter is True, else result of MySQL Query
+        :return: ID of added row if questions parameter is True, else result of SQL Query
     """
 
-    # Name of database section in config file
-    configname = 'dbconfig'
+    db = storage_backend()
 
     try:
-        with connect(
-            
-            # Database credentials from config file
-            host=config[configname]['Host'],
-            user=config[configname]['User'],
-            password=config[configname]['Pass'],
-            database="opentriviata",
-        ) as connection:
+        with db.connection() as connection, metrics.timed('db_query_seconds'):
 
             for db_query in db_queries:
                 use_prepared = type(db_query) is dict            
-                with connection.cursor(prepared=use_prepared) as cursor:
+                with db.cursor(connection, prepared=use_prepared) as raw_cursor:
+                    cursor = metrics.MeteredCursor(raw_cursor)
+
                     if use_prepared:
                         cursor.execute(db_query['query'], db_query['values'])
                     else:
@@ -546,12 +1849,57 @@ def db_query(db_queries, questions = False):
                     # only a single item when performing a SELECT operation
                    
                     query_results = cursor.fetchall()
-                    connection.commit()
+
+            with metrics.db_round_trip('commit'):
+                connection.commit()
 
             if questions:
                 return cursor.lastrowid
             return query_results[0] if len(query_results) else 0
 
-    except Error as e:
+    except db.errors as e:
+        print(e)
+
+
+def db_transaction(work):
+
+    """ Run a unit of work against the database, committing once when it completes
+
+        :param work: Function to call with a cursor for the open transaction
+        :return: Result of work or None if the transaction was rolled back
+    """
+
+    db = storage_backend()
+
+    try:
+        with db.connection() as connection, metrics.timed('db_transaction_seconds'):
+            try:
+                with db.cursor(connection) as cursor:
+                    result = work(metrics.MeteredCursor(cursor))
+
+                with metrics.db_round_trip('commit'):
+                    connection.commit()
+
+            except db.errors:
+                connection.rollback()
+                raise
+
+            return result
+
+    except db.errors as e:
         print(e)
 
+
+def storage_backend():
+
+    """ Get the storage backend selected in appconfig.ini, creating it on first use
+
+        :return: storage.MySQLBackend or storage.SQLiteBackend
+    """
+
+    global backend
+
+    if backend is None:
+        backend = storage.create_backend(config)
+
+    return backend
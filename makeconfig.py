@@ -7,6 +7,9 @@ parser.add_argument('-f', '--filename', help='filename for the generated ini fil
 parser.add_argument('-w', '--hostname', help='hostname', default='localhost')
 parser.add_argument('-u', '--username', help='username', default='root')
 parser.add_argument('-p', '--password', help='password', required=True)
+parser.add_argument('-s', '--poolsize', help='number of pooled database connections', default='5')
+parser.add_argument('-q', '--queuedepth', help='number of fetched pages that can wait to be written', default='4')
+parser.add_argument('-r', '--rate', help='maximum Open Trivia API requests per second', default='0.2')
 args = parser.parse_args()
 configname = getattr(args, 'filename')
 
@@ -17,6 +20,13 @@ config['dbconfig'] = {}
 config['dbconfig']['Host'] = getattr(args, 'hostname')
 config['dbconfig']['User'] = getattr(args, 'username')
 config['dbconfig']['Pass'] = getattr(args, 'password')
+config['dbconfig']['pool_size'] = getattr(args, 'poolsize')
+
+config['syncconfig'] = {}
+config['syncconfig']['queue_depth'] = getattr(args, 'queuedepth')
+
+config['apiconfig'] = {}
+config['apiconfig']['rate'] = getattr(args, 'rate')
 
 config['tokenconfig'] = {}
 config['tokenconfig']['api_token'] = ""
@@ -0,0 +1,210 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+from fileutils import write_atomically
+
+PROMETHEUS_PREFIX = "opentriviata_sync_"
+
+lock = threading.Lock()
+started = time.time()
+
+# Values keyed by (metric name, sorted label tuple)
+counters = {}
+timings = {}
+
+
+def metric_key(name, labels):
+
+    """ :return: Hashable key for the metric and its labels
+    """
+
+    return (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+
+
+def increment(name, amount = 1, **labels):
+
+    """ Add to a counter
+
+        :param name: Name of the counter
+        :param amount: Amount to add
+        :param labels: Labels identifying the series, eg endpoint='api.php'
+    """
+
+    key = metric_key(name, labels)
+
+    with lock:
+        counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name, seconds, **labels):
+
+    """ Record how long something took
+
+        :param name: Name of the timing
+        :param seconds: Duration to record
+        :param labels: Labels identifying the series
+    """
+
+    key = metric_key(name, labels)
+
+    with lock:
+        timing = timings.setdefault(key, {'count': 0, 'sum': 0.0, 'max': 0.0})
+        timing['count'] += 1
+        timing['sum'] += seconds
+        timing['max'] = max(timing['max'], seconds)
+
+
+@contextmanager
+def timed(name, **labels):
+
+    """ Record how long the body of a with statement takes
+    """
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+@contextmanager
+def db_round_trip(kind, count = 1):
+
+    """ Count and time a call to the database server
+
+        :param kind: What the call is for, eg 'statement', 'commit' or 'ping'
+        :param count: Number of round trips the call makes
+    """
+
+    increment('db_round_trips_total', count, kind=kind)
+
+    with timed('db_round_trip_seconds', kind=kind):
+        yield
+
+
+class MeteredCursor:
+
+    """ Database cursor wrapper that counts and times every statement sent to the server
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        with db_round_trip('statement'):
+            return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, operation, seq_params, *args, **kwargs):
+        seq_params = list(seq_params)
+
+        # mysql.connector sends an INSERT as one multi-row statement, but anything else once per row
+        round_trips = 1 if operation.lstrip().upper().startswith('INSERT') else len(seq_params)
+
+        with db_round_trip('statement', round_trips):
+            return self.cursor.executemany(operation, seq_params, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def report():
+
+    """ Summarise the run so far
+
+        :return: dict of counters, timings and per category throughput
+    """
+
+    with lock:
+        counter_values = dict(counters)
+        timing_values = {key: dict(timing) for key, timing in timings.items()}
+
+    def series(values):
+        return [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(values.items())]
+
+    categories = {}
+
+    for (name, labels), timing in timing_values.items():
+        if name == 'category_sync_seconds':
+            category_id = dict(labels)['category']
+            inserted = counter_values.get(metric_key('questions_inserted_total', {'category': category_id}), 0)
+            categories[category_id] = {
+                'seconds': round(timing['sum'], 3),
+                'inserted': inserted,
+                'questions_per_second': round(inserted / timing['sum'], 2) if timing['sum'] else 0
+            }
+
+    return {
+        'started': started,
+        'elapsed_seconds': round(time.time() - started, 3),
+        'counters': series(counter_values),
+        'timings': series(timing_values),
+        'categories': categories
+    }
+
+
+def write_report(path):
+
+    """ Save the run report as JSON
+
+        :param path: File to write
+    """
+
+    write_atomically(path, lambda report_file: json.dump(report(), report_file, indent=2))
+
+
+def prometheus_labels(labels):
+
+    """ :return: Labels in Prometheus exposition format
+    """
+
+    if not labels:
+        return ""
+
+    def escape(value):
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{label}="{escape(value)}"' for label, value in labels) + "}"
+
+
+def write_prometheus(path):
+
+    """ Save the metrics in Prometheus textfile collector format
+
+        :param path: File to write - should end in .prom
+    """
+
+    with lock:
+        counter_values = sorted(counters.items())
+        timing_values = sorted((key, dict(timing)) for key, timing in timings.items())
+
+    lines = [
+        f"# TYPE {PROMETHEUS_PREFIX}elapsed_seconds gauge",
+        f"{PROMETHEUS_PREFIX}elapsed_seconds {time.time() - started:.3f}"
+    ]
+    typed = set()
+
+    for (name, labels), value in counter_values:
+        if not name in typed:
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} counter")
+            typed.add(name)
+
+        lines.append(f"{PROMETHEUS_PREFIX}{name}{prometheus_labels(labels)} {value}")
+
+    for (name, labels), timing in timing_values:
+        if not name in typed:
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} summary")
+            typed.add(name)
+
+        lines.append(f"{PROMETHEUS_PREFIX}{name}_sum{prometheus_labels(labels)} {timing['sum']:.6f}")
+        lines.append(f"{PROMETHEUS_PREFIX}{name}_count{prometheus_labels(labels)} {timing['count']}")
+
+    for (name, labels), timing in timing_values:
+        if not f"{name}_max" in typed:
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name}_max gauge")
+            typed.add(f"{name}_max")
+
+        lines.append(f"{PROMETHEUS_PREFIX}{name}_max{prometheus_labels(labels)} {timing['max']:.6f}")
+
+    write_atomically(path, lambda prometheus_file: prometheus_file.write("\n".join(lines) + "\n"))
@@ -0,0 +1,230 @@
+import html
+import json
+import base64
+import hashlib
+import unicodedata
+from urllib.parse import unquote
+
+# Encoding requested from api.php - percent-encoding is lossless and cheap to decode
+API_ENCODING = "url3986"
+
+
+class Question:
+
+    """ A question returned by the API, decoded once into a compact record
+
+        Slots keep each record to a fixed set of attributes with no per-instance dict, so pages held in the pipeline queue stay small
+    """
+
+    __slots__ = ('category_id', 'category', 'type', 'difficulty', 'text', 'correct_answer', 'incorrect_answers', 'fingerprint', 'content_hash')
+
+    def __init__(self, category_id, category, question_type, difficulty, text, correct_answer, incorrect_answers):
+
+        """ :param category_id: Id number of the category the question belongs to
+            :param category: Name of the category
+            :param question_type: 'multiple' or 'boolean'
+            :param difficulty: 'easy', 'medium' or 'hard'
+            :param text: Text of the question
+            :param correct_answer: Text of the correct answer
+            :param incorrect_answers: Tuple of the incorrect answers
+        """
+
+        self.category_id = category_id
+        self.category = category
+        self.type = question_type
+        self.difficulty = difficulty
+        self.text = text
+        self.correct_answer = correct_answer
+        self.incorrect_answers = incorrect_answers
+        self.fingerprint = question_fingerprint(text)
+        self.content_hash = content_fingerprint(text, question_type, difficulty, correct_answer, incorrect_answers)
+
+    @classmethod
+    def from_api(cls, category_id, question_details, encoding = API_ENCODING):
+
+        """ :param category_id: Id number of the category the question was requested for
+            :param question_details: Question dictionary from the API results list
+            :param encoding: Encoding the API was asked for - 'default' for HTML entities
+            :return: Question with the text decoded
+        """
+
+        return cls(
+            category_id,
+            decode_text(question_details['category'], encoding),
+            decode_text(question_details['type'], encoding),
+            decode_text(question_details['difficulty'], encoding),
+            decode_text(question_details['question'], encoding),
+            decode_text(question_details['correct_answer'], encoding),
+            tuple(decode_text(incorrect_answer, encoding) for incorrect_answer in question_details['incorrect_answers'])
+        )
+
+    def question_row(self):
+
+        """ :return: Values for the category_id, type, difficulty, question_text, question_html, question_hash and content_hash columns
+        """
+
+        return (self.category_id, self.type, self.difficulty, self.text, escape_html(self.text), self.fingerprint, self.content_hash)
+
+    def documents(self, question_id):
+
+        """ :param question_id: Id number of the stored question
+            :return: Tuple of the question's JSON document with plain text and with HTML-escaped text
+        """
+
+        details = (question_id, self.category, self.type, self.difficulty, self.text, self.correct_answer, self.incorrect_answers)
+
+        return (question_document(*details), question_document(*details, escape=True))
+
+    def answer_rows(self, question_id):
+
+        """ Get the rows for the answers table
+
+            :param question_id: Id number of the stored question, or anything else that identifies it, eg its fingerprint
+            :return: Generator of (question_id, answer, answer_html, correct) tuples
+        """
+
+        if self.type == 'boolean':
+            # Only whether the statement is true is stored
+            yield (question_id, None, None, int(self.correct_answer == "True"))
+            return
+
+        for incorrect_answer in self.incorrect_answers:
+            yield (question_id, incorrect_answer, escape_html(incorrect_answer), 0)
+
+        yield (question_id, self.correct_answer, escape_html(self.correct_answer), 1)
+
+
+def decode_page(category_id, questions, encoding = API_ENCODING):
+
+    """ :param category_id: Id number of the category the questions were requested for
+        :param questions: List of question dictionaries from the API, or None
+        :param encoding: Encoding the API was asked for - 'default' for HTML entities
+        :return: List of Question records, or None if no questions were given
+    """
+
+    if questions is None:
+        return
+
+    return [Question.from_api(category_id, question_details, encoding) for question_details in questions]
+
+
+def decode_text(value, encoding):
+
+    """ :param value: Text as returned by the API
+        :param encoding: Encoding the API was asked for - 'url3986', 'base64' or 'default' for HTML entities
+        :return: Plain text
+    """
+
+    if encoding == 'url3986':
+        return unquote(value)
+
+    if encoding == 'base64':
+        return base64.b64decode(value).decode('utf-8')
+
+    return html.unescape(value)
+
+
+def escape_html(text):
+
+    """ :param text: Plain text
+        :return: Text escaped for HTML, with quotes escaped as PHP's htmlspecialchars() does
+    """
+
+    return html.escape(text).replace("&#x27;", "&#039;")
+
+
+def question_fingerprint(question_text):
+
+    """ Get a fixed-width fingerprint of the normalised question text
+
+        Case, accents and spacing are ignored, much as they are by the collation of the question_text column
+
+        :param question_text: Text of the question
+        :return: 16 byte digest
+    """
+
+    decomposed = unicodedata.normalize('NFKD', question_text)
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    normalised = " ".join(stripped.casefold().split())
+
+    return hashlib.md5(normalised.encode('utf-8')).digest()
+
+
+def content_fingerprint(question_text, question_type, difficulty, correct_answer, incorrect_answers):
+
+    """ Get a fingerprint of everything stored for a question, so upstream corrections can be spotted
+
+        Unlike question_fingerprint(), the text is used exactly as given. The order of the incorrect answers is ignored.
+
+        :param question_text: Text of the question
+        :param question_type: 'multiple' or 'boolean'
+        :param difficulty: 'easy', 'medium' or 'hard'
+        :param correct_answer: Text of the correct answer
+        :param incorrect_answers: The incorrect answers
+        :return: 16 byte digest
+    """
+
+    fields = [question_text, question_type, difficulty, correct_answer] + sorted(incorrect_answers)
+
+    # Unit separators keep the boundaries between fields unambiguous
+    return hashlib.md5("\x1f".join(fields).encode('utf-8')).digest()
+
+
+def stored_content_fingerprint(question_text, question_type, difficulty, answers):
+
+    """ Get the content fingerprint of a question from its stored rows
+
+        :param question_text: Text of the question
+        :param question_type: 'multiple' or 'boolean'
+        :param difficulty: 'easy', 'medium' or 'hard'
+        :param answers: List of (answer, correct) tuples from the answers table
+        :return: 16 byte digest
+    """
+
+    return content_fingerprint(question_text, question_type, difficulty, *stored_answers(question_type, answers))
+
+
+def stored_answers(question_type, answers):
+
+    """ Rebuild the answers the API gives for a question from its rows in the answers table
+
+        :param question_type: 'multiple' or 'boolean'
+        :param answers: List of (answer, correct) tuples from the answers table
+        :return: Tuple of the correct answer and a list of the incorrect answers
+    """
+
+    if question_type == 'boolean':
+        # Only whether the statement is true is stored
+        correct_answer = "True" if any(correct for answer, correct in answers) else "False"
+        return correct_answer, ["False" if correct_answer == "True" else "True"]
+
+    correct_answer = next((answer for answer, correct in answers if correct), "")
+    return correct_answer, [answer for answer, correct in answers if not correct]
+
+
+def question_document(question_id, category, question_type, difficulty, question_text, correct_answer, incorrect_answers, escape = False):
+
+    """ Get the JSON document served for a question - an Open Trivia result with the question's id added
+
+        :param question_id: Id number of the stored question
+        :param category: Name of the category
+        :param question_type: 'multiple' or 'boolean'
+        :param difficulty: 'easy', 'medium' or 'hard'
+        :param question_text: Text of the question
+        :param correct_answer: Text of the correct answer
+        :param incorrect_answers: The incorrect answers
+        :param escape: Escape the text for HTML, as the API does by default
+        :return: JSON text
+    """
+
+    text = escape_html if escape else str
+
+    return json.dumps({
+        'id': question_id,
+        'type': question_type,
+        'difficulty': difficulty,
+        'category': text(category),
+        'question': text(question_text),
+        'correct_answer': text(correct_answer),
+        'incorrect_answers': [text(incorrect_answer) for incorrect_answer in incorrect_answers]
+    }, ensure_ascii=False)
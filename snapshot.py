@@ -0,0 +1,329 @@
+import sys
+import mmap
+import random
+import struct
+import hashlib
+from bisect import bisect_left
+from fileutils import write_atomically
+
+# Layout of a snapshot file - every number is little-endian and every section starts on an 8 byte boundary
+#
+#   header          HEADER
+#   categories      CATEGORY record per category, by id
+#   question ids    unsigned 32 bit question id per question, ascending
+#   questions       QUESTION record per question, in the same order as the ids
+#   buckets         BUCKET record per category/difficulty/type, sorted
+#   bucket rows     unsigned 32 bit question row number per question, grouped by bucket
+#   heap            UTF-8 category names and question documents, referred to by offset and length
+MAGIC = b"OTDBSNAP"
+VERSION = 2
+
+# Counts, the last change included, the identifier of the database it was taken from, a fingerprint of the categories
+# and the offset of each section
+HEADER = struct.Struct("<8sIIII4xQ16s16sQQQQQQ")
+CATEGORY = struct.Struct("<IIQ")
+QUESTION = struct.Struct("<IBB2xQIQI")
+BUCKET = struct.Struct("<IBB2xII")
+ROW = struct.Struct("<I")
+
+# Difficulties and types are stored as their position in these tuples
+DIFFICULTIES = ('easy', 'medium', 'hard')
+TYPES = ('multiple', 'boolean')
+
+
+class SnapshotError(ValueError):
+
+    """ The file isn't a snapshot this module can read
+    """
+
+
+def aligned(offset):
+
+    """ :return: Offset rounded up to the next 8 byte boundary
+    """
+
+    return (offset + 7) & ~7
+
+
+def categories_fingerprint(categories):
+
+    """ :param categories: dict of category names by id
+        :return: 16 byte digest that changes whenever a category is added, removed or renamed
+    """
+
+    # Unit separators keep the boundaries between fields unambiguous
+    return hashlib.md5("\x1f".join(f"{category_id}\x1f{categories[category_id]}" for category_id in sorted(categories)).encode('utf-8')).digest()
+
+
+def write_snapshot(path, categories, questions, last_change_id, database_id):
+
+    """ Write a snapshot file, replacing any existing one only once it's complete
+
+        Readers that already have the old file mapped keep reading it until they reopen the path
+
+        :param path: File to write
+        :param categories: dict of category names by id
+        :param questions: dict of (category id, difficulty, type, document, document_html) tuples by question id, with
+            the documents as UTF-8 bytes
+        :param last_change_id: Last change in the change feed included in the snapshot
+        :param database_id: 16 byte identifier of the database the snapshot was taken from
+    """
+
+    heap = bytearray()
+
+    def heap_string(value):
+        offset = len(heap)
+        heap.extend(value)
+        return offset, len(value)
+
+    category_records = []
+
+    for category_id in sorted(categories):
+        offset, length = heap_string(categories[category_id].encode('utf-8'))
+        category_records.append(CATEGORY.pack(category_id, length, offset))
+
+    question_ids = sorted(questions)
+    question_records = []
+    buckets = {}
+
+    for row, question_id in enumerate(question_ids):
+        category_id, difficulty, question_type, document, document_html = questions[question_id]
+        difficulty_code = DIFFICULTIES.index(difficulty)
+        type_code = TYPES.index(question_type)
+
+        question_records.append(QUESTION.pack(category_id, difficulty_code, type_code, *heap_string(document), *heap_string(document_html)))
+        buckets.setdefault((category_id, difficulty_code, type_code), []).append(row)
+
+    bucket_records = []
+    bucket_rows = []
+
+    for bucket in sorted(buckets):
+        bucket_records.append(BUCKET.pack(*bucket, len(bucket_rows), len(buckets[bucket])))
+        bucket_rows.extend(buckets[bucket])
+
+    sections = [
+        b"".join(category_records),
+        struct.pack(f"<{len(question_ids)}I", *question_ids),
+        b"".join(question_records),
+        b"".join(bucket_records),
+        struct.pack(f"<{len(bucket_rows)}I", *bucket_rows),
+        bytes(heap)
+    ]
+
+    offsets = []
+    offset = aligned(HEADER.size)
+
+    for section in sections:
+        offsets.append(offset)
+        offset = aligned(offset + len(section))
+
+    def write(snapshot_file):
+        snapshot_file.write(HEADER.pack(MAGIC, VERSION, len(category_records), len(question_ids), len(bucket_records), last_change_id, database_id, categories_fingerprint(categories), *offsets))
+
+        for section_offset, section in zip(offsets, sections):
+            snapshot_file.seek(section_offset)
+            snapshot_file.write(section)
+
+    write_atomically(path, write, binary=True)
+
+
+class Snapshot:
+
+    """ Read-only view of a snapshot file, mapped into memory
+
+        Nothing is read up front - lookups go straight to the mapped pages, so opening even a large snapshot is
+        instant and processes mapping the same file share its pages. Documents are returned as memoryviews of the
+        mapping, so they can be written to a response without being copied. Release them before closing the snapshot.
+    """
+
+    def __init__(self, path):
+
+        """ :param path: Snapshot file written by write_snapshot()
+        """
+
+        if sys.byteorder != 'little':
+            # Id arrays are read in place as native unsigned ints
+            raise SnapshotError("Snapshots can only be read on little-endian hosts")
+
+        with open(path, 'rb') as snapshot_file:
+            try:
+                self.map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise SnapshotError(f"{path} is empty")
+
+        self.view = memoryview(self.map)
+
+        if len(self.map) < HEADER.size:
+            self.close()
+            raise SnapshotError(f"{path} is too short to be a snapshot")
+
+        magic, version, self.category_count, self.question_count, self.bucket_count, self.last_change_id, self.database_id, self.categories_hash, *offsets = HEADER.unpack_from(self.map)
+
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise SnapshotError(f"{path} is not a version {VERSION} snapshot")
+
+        self.categories_offset, ids_offset, self.questions_offset, self.buckets_offset, rows_offset, self.heap_offset = offsets
+        self.path = path
+
+        # A truncated or corrupt header would otherwise surface as wrong answers or errors from deep inside a lookup
+        self.check_section(self.categories_offset, self.category_count * CATEGORY.size)
+        self.check_section(ids_offset, self.question_count * ROW.size)
+        self.check_section(self.questions_offset, self.question_count * QUESTION.size)
+        self.check_section(self.buckets_offset, self.bucket_count * BUCKET.size)
+        self.check_section(self.heap_offset, 0)
+
+        self.ids = self.view[ids_offset:ids_offset + self.question_count * ROW.size].cast('I')
+        self.buckets = [BUCKET.unpack_from(self.map, self.buckets_offset + index * BUCKET.size) for index in range(self.bucket_count)]
+        row_count = sum(bucket[4] for bucket in self.buckets)
+
+        if any(bucket[3] + bucket[4] > row_count for bucket in self.buckets):
+            self.close()
+            raise SnapshotError(f"{path} has a bucket outside its bucket rows")
+
+        self.check_section(rows_offset, row_count * ROW.size)
+        self.bucket_rows = self.view[rows_offset:rows_offset + row_count * ROW.size].cast('I')
+
+    def check_section(self, offset, length):
+
+        """ Make sure a section lies within the file, closing the snapshot if it doesn't
+
+            :param offset: Start of the section
+            :param length: Size of the section in bytes
+        """
+
+        if offset + length > len(self.map):
+            self.close()
+            raise SnapshotError(f"{self.path} is truncated or corrupt - a section ends past the end of the file")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+
+        """ Unmap the file
+        """
+
+        for attribute in ['ids', 'bucket_rows', 'view']:
+            if hasattr(self, attribute):
+                getattr(self, attribute).release()
+
+        self.map.close()
+
+    def heap_string(self, offset, length):
+
+        """ :return: memoryview of a string in the heap
+        """
+
+        start = self.heap_offset + offset
+
+        if start + length > len(self.map):
+            raise SnapshotError(f"{self.path} is truncated or corrupt - a string ends past the end of the file")
+
+        return self.view[start:start + length]
+
+    def categories(self):
+
+        """ :return: dict of category names by id
+        """
+
+        categories = {}
+
+        for index in range(self.category_count):
+            category_id, length, offset = CATEGORY.unpack_from(self.map, self.categories_offset + index * CATEGORY.size)
+            categories[category_id] = str(self.heap_string(offset, length), 'utf-8')
+
+        return categories
+
+    def row(self, question_id):
+
+        """ :param question_id: Id number of a question
+            :return: Row number of the question in the snapshot or None if it isn't there
+        """
+
+        row = bisect_left(self.ids, question_id)
+
+        if row < self.question_count and self.ids[row] == question_id:
+            return row
+
+    def question(self, row):
+
+        """ :param row: Row number of a question in the snapshot
+            :return: Tuple of (question id, category id, difficulty, type, document, document_html)
+        """
+
+        category_id, difficulty_code, type_code, document_offset, document_length, html_offset, html_length = QUESTION.unpack_from(self.map, self.questions_offset + row * QUESTION.size)
+
+        return (self.ids[row], category_id, DIFFICULTIES[difficulty_code], TYPES[type_code], self.heap_string(document_offset, document_length), self.heap_string(html_offset, html_length))
+
+    def document(self, question_id, html = False):
+
+        """ Get a question's JSON document - an Open Trivia result with the question's id added
+
+            :param question_id: Id number of the question
+            :param html: Get the document with HTML-escaped text
+            :return: memoryview of the UTF-8 document or None if the question isn't in the snapshot
+        """
+
+        row = self.row(question_id)
+
+        if row is None:
+            return
+
+        return self.question(row)[5 if html else 4]
+
+    def documents(self, question_ids, html = False):
+
+        """ :param question_ids: Id numbers of the questions, eg from an id list request
+            :param html: Get the documents with HTML-escaped text
+            :return: List of memoryviews of the documents of the questions found, in the order asked for
+        """
+
+        documents = (self.document(question_id, html) for question_id in question_ids)
+        return [document for document in documents if document is not None]
+
+    def matching_buckets(self, category = None, difficulty = None, question_type = None):
+
+        """ :return: List of the buckets with the given category, difficulty and type - None matches anything
+        """
+
+        difficulty_code = None if difficulty is None else DIFFICULTIES.index(difficulty)
+        type_code = None if question_type is None else TYPES.index(question_type)
+
+        return [
+            bucket for bucket in self.buckets
+            if category in (None, bucket[0]) and difficulty_code in (None, bucket[1]) and type_code in (None, bucket[2])
+        ]
+
+    def question_ids(self, category = None, difficulty = None, question_type = None):
+
+        """ :return: List of the ids of the questions with the given category, difficulty and type - None matches anything
+        """
+
+        return [self.ids[row] for bucket in self.matching_buckets(category, difficulty, question_type) for row in self.bucket_rows[bucket[3]:bucket[3] + bucket[4]]]
+
+    def random_ids(self, amount, category = None, difficulty = None, question_type = None):
+
+        """ Pick questions at random, without repeats
+
+            :param amount: Number of questions wanted
+            :return: List of question ids - shorter than amount if not enough questions match
+        """
+
+        buckets = self.matching_buckets(category, difficulty, question_type)
+        total = sum(bucket[4] for bucket in buckets)
+        picked = []
+
+        # Pick positions across the matching buckets as if they were one list
+        for position in random.sample(range(total), min(amount, total)):
+            for bucket in buckets:
+                if position < bucket[4]:
+                    picked.append(self.ids[self.bucket_rows[bucket[3] + position]])
+                    break
+
+                position -= bucket[4]
+
+        return picked
@@ -0,0 +1,662 @@
+import os
+import re
+import html
+import sys
+import uuid
+import sqlite3
+import threading
+from contextlib import contextmanager
+import metrics
+from records import escape_html, question_document, stored_answers
+
+DB_NAME = "opentriviata"
+DEFAULT_BACKEND = "mysql"
+DEFAULT_POOL_SIZE = 5
+DB_RECONNECT_ATTEMPTS = 3
+DB_RECONNECT_DELAY = 1
+DEFAULT_SQLITE_PATH = "opentriviata.sqlite3"
+SQLITE_LOAD_BATCH = 1000
+
+# Escape sequences used in LOAD DATA files
+TSV_ESCAPES = {'t': "\t", 'n': "\n", 'r': "\r", '\\': "\\"}
+
+
+def create_backend(config):
+
+    """ Create the storage backend selected in the dbconfig section of the config file
+
+        :param config: ConfigParser with a dbconfig section
+        :return: MySQLBackend or SQLiteBackend
+    """
+
+    settings = config['dbconfig']
+    backend_name = settings.get('backend', DEFAULT_BACKEND)
+
+    if backend_name == 'mysql':
+        return MySQLBackend(settings)
+
+    if backend_name == 'sqlite':
+        return SQLiteBackend(settings)
+
+    print(f"\nError: unknown storage backend '{backend_name}' - expected mysql or sqlite\n")
+    sys.exit(1)
+
+
+class MySQLBackend:
+
+    """ Pooled connections to a MySQL server
+    """
+
+    name = 'mysql'
+
+    # Locking clause for SELECTs that claim rows - rows locked by another transaction are passed over
+    skip_locked = " FOR UPDATE SKIP LOCKED"
+
+    def __init__(self, settings):
+
+        """ :param settings: dbconfig section of the config file
+        """
+
+        # Optional dependency - only needed when MySQL is the selected backend
+        from mysql.connector import Error
+
+        self.settings = settings
+        self.database = settings.get('database', DB_NAME)
+        self.errors = (Error,)
+        self.pool = None
+
+    def credentials(self, **options):
+
+        """ :return: Connection arguments from the config file, plus any options given
+        """
+
+        return dict(
+            host=self.settings['Host'],
+            user=self.settings['User'],
+            password=self.settings['Pass'],
+            **options
+        )
+
+    def create_database(self):
+
+        """ Create the database if it doesn't exist yet
+        """
+
+        from mysql.connector import connect
+
+        with connect(**self.credentials()) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f"CREATE DATABASE IF NOT EXISTS {self.database} COLLATE utf8mb4_unicode_520_ci")
+
+    def drop_database(self):
+
+        """ Remove the database and everything in it
+        """
+
+        from mysql.connector import connect
+
+        with connect(**self.credentials()) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f"DROP DATABASE IF EXISTS {self.database}")
+
+    @contextmanager
+    def connection(self):
+
+        """ Borrow a connection from the pool and return it to the pool when done
+
+            :return: Pooled connection - checked and reconnected if the server has dropped it
+        """
+
+        if self.pool is None:
+            from mysql.connector import pooling
+
+            self.pool = pooling.MySQLConnectionPool(
+                pool_name=self.database,
+                pool_size=self.settings.getint('pool_size', fallback=DEFAULT_POOL_SIZE),
+                # We keep no session state between queries, so skip the reset round trip when connections are returned
+                pool_reset_session=False,
+                **self.credentials(database=self.database)
+            )
+
+        connection = self.pool.get_connection()
+
+        try:
+            # Health check - a pooled session may have timed out while idle
+            with metrics.db_round_trip('ping'):
+                connection.ping(reconnect=True, attempts=DB_RECONNECT_ATTEMPTS, delay=DB_RECONNECT_DELAY)
+
+            yield connection
+        finally:
+            # Closing a pooled connection hands it back to the pool
+            connection.close()
+
+    @contextmanager
+    def loader_connection(self):
+
+        """ Open a connection that may use LOAD DATA LOCAL INFILE
+        """
+
+        from mysql.connector import connect
+
+        with connect(**self.credentials(database=self.database, allow_local_infile=True)) as connection:
+            yield connection
+
+    @contextmanager
+    def cursor(self, connection, prepared = False):
+
+        """ :param prepared: Use server-side prepared statements
+            :return: Cursor for the connection
+        """
+
+        with connection.cursor(prepared=prepared) as cursor:
+            yield cursor
+
+    def insert_ignore_sql(self, table, columns, row_count = 1):
+
+        """ :return: Multi-row INSERT that skips rows duplicating a unique key
+        """
+
+        rows = ", ".join([f"({', '.join(['%s'] * len(columns))})"] * row_count)
+        return f"INSERT INTO {table} ({', '.join(columns)}) VALUES {rows} ON DUPLICATE KEY UPDATE {columns[0]}={columns[0]}"
+
+    def insert_select_ignore_sql(self, table, columns, select):
+
+        """ :param select: SELECT query with a WHERE clause, for compatibility with SQLite
+            :return: INSERT ... SELECT that skips rows duplicating a unique key
+        """
+
+        return f"INSERT INTO {table} ({', '.join(columns)}) {select} ON DUPLICATE KEY UPDATE {columns[0]}={columns[0]}"
+
+    def upsert_sql(self, table, columns, keys, row_count = 1, updated = None):
+
+        """ :param updated: Columns to overwrite - all the non-key columns if None
+            :return: Multi-row INSERT that overwrites columns of an existing row with the same keys
+        """
+
+        rows = ", ".join([f"({', '.join(['%s'] * len(columns))})"] * row_count)
+        updates = ", ".join(f"{column} = VALUES({column})" for column in (updated or [column for column in columns if not column in keys]))
+        return f"INSERT INTO {table} ({', '.join(columns)}) VALUES {rows} ON DUPLICATE KEY UPDATE {updates}"
+
+    def serialise(self, cursor, table):
+
+        """ Make other transactions that call serialise() on the table wait until this one ends
+
+            :param cursor: Cursor for the open transaction
+            :param table: Table to lock
+        """
+
+        cursor.execute(f"SELECT COUNT(*) FROM {table} FOR UPDATE")
+        cursor.fetchall()
+
+    def column_exists(self, cursor, table, column):
+
+        """ :return: True if the table already has the given column
+        """
+
+        cursor.execute("SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s", (table, column))
+        return cursor.fetchone()[0] > 0
+
+    def index_exists(self, cursor, table, index):
+
+        """ :return: True if the table already has the given index
+        """
+
+        cursor.execute("SELECT COUNT(*) FROM information_schema.statistics WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s", (table, index))
+        return cursor.fetchone()[0] > 0
+
+    def bulk_load(self, cursor, table, columns, path, binary_columns = ()):
+
+        """ Load a tab separated file into a table with LOAD DATA LOCAL INFILE
+
+            :param cursor: Cursor for a loader_connection()
+            :param table: Table to load
+            :param columns: Column for each field in the file
+            :param path: Path of the file
+            :param binary_columns: Columns whose fields are hex encoded
+        """
+
+        fields = ", ".join(f"@{column}" if column in binary_columns else column for column in columns)
+        conversions = ", ".join(f"{column} = UNHEX(@{column})" for column in binary_columns)
+
+        cursor.execute(f"LOAD DATA LOCAL INFILE %s INTO TABLE {table} CHARACTER SET utf8mb4 ({fields})" + (f" SET {conversions}" if conversions else ""), (path,))
+
+
+class SQLiteCursor:
+
+    """ sqlite3 cursor that accepts the %s placeholders used throughout the synchroniser
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, values = ()):
+        return self.cursor.execute(query.replace("%s", "?"), values)
+
+    def executemany(self, query, values):
+        return self.cursor.executemany(query.replace("%s", "?"), values)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class SQLiteBackend:
+
+    """ Embedded SQLite database file - no server or network round trips
+    """
+
+    name = 'sqlite'
+
+    # SQLite has no row locks - claims rely on a conditional UPDATE instead
+    skip_locked = ""
+
+    def __init__(self, settings):
+
+        """ :param settings: dbconfig section of the config file
+        """
+
+        self.path = settings.get('path', DEFAULT_SQLITE_PATH)
+        self.errors = (sqlite3.Error,)
+        self.lock = threading.RLock()
+        self.shared_connection = None
+
+    def create_database(self):
+
+        """ Nothing to do - the file is created when first connected to
+        """
+
+    def drop_database(self):
+
+        """ Remove the database file along with its write-ahead log
+        """
+
+        with self.lock:
+            if self.shared_connection is not None:
+                self.shared_connection.close()
+                self.shared_connection = None
+
+            for suffix in ["", "-wal", "-shm"]:
+                if os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
+
+    @contextmanager
+    def connection(self):
+
+        """ Borrow the shared connection - callers on other threads wait until it is handed back
+
+            :return: sqlite3 connection
+        """
+
+        with self.lock:
+            if self.shared_connection is None:
+                self.shared_connection = sqlite3.connect(self.path, check_same_thread=False)
+
+                # Write-ahead logging lets readers carry on while a page is written, and only the log is synced per commit
+                self.shared_connection.execute("PRAGMA journal_mode = WAL")
+                self.shared_connection.execute("PRAGMA synchronous = NORMAL")
+                self.shared_connection.execute("PRAGMA foreign_keys = ON")
+
+            yield self.shared_connection
+
+    def loader_connection(self):
+
+        """ :return: The shared connection - SQLite needs nothing special for bulk loads
+        """
+
+        return self.connection()
+
+    @contextmanager
+    def cursor(self, connection, prepared = False):
+
+        """ :param prepared: Ignored - sqlite3 caches prepared statements itself
+            :return: Cursor for the connection
+        """
+
+        cursor = connection.cursor()
+
+        try:
+            yield SQLiteCursor(cursor)
+        finally:
+            cursor.close()
+
+    def insert_ignore_sql(self, table, columns, row_count = 1):
+
+        """ :return: Multi-row INSERT that skips rows duplicating a unique key
+        """
+
+        rows = ", ".join([f"({', '.join(['%s'] * len(columns))})"] * row_count)
+        return f"INSERT INTO {table} ({', '.join(columns)}) VALUES {rows} ON CONFLICT DO NOTHING"
+
+    def insert_select_ignore_sql(self, table, columns, select):
+
+        """ :param select: SELECT query with a WHERE clause - SQLite needs one to tell the upsert clause apart from a join constraint
+            :return: INSERT ... SELECT that skips rows duplicating a unique key
+        """
+
+        return f"INSERT INTO {table} ({', '.join(columns)}) {select} ON CONFLICT DO NOTHING"
+
+    def upsert_sql(self, table, columns, keys, row_count = 1, updated = None):
+
+        """ :param updated: Columns to overwrite - all the non-key columns if None
+            :return: Multi-row INSERT that overwrites columns of an existing row with the same keys
+        """
+
+        rows = ", ".join([f"({', '.join(['%s'] * len(columns))})"] * row_count)
+        updates = ", ".join(f"{column} = excluded.{column}" for column in (updated or [column for column in columns if not column in keys]))
+        return f"INSERT INTO {table} ({', '.join(columns)}) VALUES {rows} ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {updates}"
+
+    def serialise(self, cursor, table):
+
+        """ Make other transactions that call serialise() on the table wait until this one ends
+
+            :param cursor: Cursor for the open transaction
+            :param table: Table to lock - SQLite locks the whole database
+        """
+
+        # Any write takes the database's write lock, even one that changes nothing
+        cursor.execute(f"UPDATE {table} SET rowid = rowid WHERE 0")
+
+    def column_exists(self, cursor, table, column):
+
+        """ :return: True if the table already has the given column
+        """
+
+        cursor.execute(f"PRAGMA table_info({table})")
+        return any(row[1] == column for row in cursor.fetchall())
+
+    def index_exists(self, cursor, table, index):
+
+        """ :return: True if the table already has the given index
+        """
+
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND name = %s", (table, index))
+        return cursor.fetchone()[0] > 0
+
+    def bulk_load(self, cursor, table, columns, path, binary_columns = ()):
+
+        """ Load a tab separated file into a table in batches
+
+            :param cursor: Cursor for a loader_connection()
+            :param table: Table to load
+            :param columns: Column for each field in the file
+            :param path: Path of the file
+            :param binary_columns: Columns whose fields are hex encoded
+        """
+
+        query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+        binary_fields = [position for position, column in enumerate(columns) if column in binary_columns]
+        rows = []
+
+        with open(path, encoding='utf-8', newline='') as load_file:
+            for line in load_file:
+                values = [tsv_value(field) for field in line.rstrip("\n").split("\t")]
+
+                for position in binary_fields:
+                    values[position] = bytes.fromhex(values[position])
+
+                rows.append(values)
+
+                if len(rows) >= SQLITE_LOAD_BATCH:
+                    cursor.executemany(query, rows)
+                    rows = []
+
+        if rows:
+            cursor.executemany(query, rows)
+
+
+def tsv_field(value):
+
+    """ Format a value for a LOAD DATA file using the default escaping
+
+        :param value: String, number or None
+        :return: Escaped field
+    """
+
+    if value is None:
+        return "\\N"
+
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def tsv_value(field):
+
+    """ Read a field written by tsv_field()
+
+        :param field: Escaped field
+        :return: String or None
+    """
+
+    if field == "\\N":
+        return None
+
+    return re.sub(r"\\(.)", lambda match: TSV_ESCAPES.get(match.group(1), match.group(1)), field)
+
+
+def fill_documents(cursor):
+
+    """ Build the JSON documents of stored questions that don't have them yet
+
+        :param cursor: Cursor for the open transaction
+        :return: Number of documents built
+    """
+
+    stored = {}
+
+    cursor.execute("SELECT questions.id, categories.category, questions.type, questions.difficulty, questions.question_text, answers.answer, answers.correct FROM questions JOIN categories ON categories.id = questions.category_id JOIN answers ON answers.question_id = questions.id WHERE questions.document IS NULL ORDER BY questions.id")
+
+    for question_id, category, question_type, difficulty, question_text, answer, correct in cursor.fetchall():
+        stored.setdefault(question_id, (category, question_type, difficulty, question_text, []))[4].append((answer, correct))
+
+    documents = []
+
+    for question_id, (category, question_type, difficulty, question_text, answers) in stored.items():
+        details = (question_id, category, question_type, difficulty, question_text) + stored_answers(question_type, answers)
+        documents.append((question_document(*details), question_document(*details, escape=True), question_id))
+
+    if documents:
+        cursor.executemany("UPDATE questions SET document = %s, document_html = %s WHERE id = %s", documents)
+
+    return len(documents)
+
+
+def create_tables(backend, cursor):
+
+    """ Migration 1: the original schema
+    """
+
+    if backend.name == 'mysql':
+        # Now using MySQL server version 8.0.26 which uses utf8mb4 character set by default. So we need to allow up to four bytes per character.
+        db_queries = [
+            "CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY NOT NULL, category VARCHAR(255) NOT NULL UNIQUE)",
+            "CREATE TABLE IF NOT EXISTS questions (id INTEGER PRIMARY KEY AUTO_INCREMENT NOT NULL, category_id INTEGER NOT NULL, type VARCHAR(16) NOT NULL, difficulty VARCHAR(16) NOT NULL, question_text VARCHAR(768) NOT NULL UNIQUE, FOREIGN KEY(category_id) REFERENCES categories(id) ON DELETE CASCADE)",
+            "CREATE TABLE IF NOT EXISTS answers (question_id INTEGER NOT NULL, answer VARCHAR(768), correct BOOLEAN NOT NULL, FOREIGN KEY(question_id) REFERENCES questions(id) ON DELETE CASCADE)"
+        ]
+    else:
+        # NOCASE stands in for MySQL's case insensitive collation when spotting duplicate questions
+        db_queries = [
+            "CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY NOT NULL, category VARCHAR(255) NOT NULL UNIQUE)",
+            "CREATE TABLE IF NOT EXISTS questions (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, category_id INTEGER NOT NULL, type VARCHAR(16) NOT NULL, difficulty VARCHAR(16) NOT NULL, question_text VARCHAR(768) NOT NULL COLLATE NOCASE UNIQUE, FOREIGN KEY(category_id) REFERENCES categories(id) ON DELETE CASCADE)",
+            "CREATE TABLE IF NOT EXISTS answers (question_id INTEGER NOT NULL, answer VARCHAR(768), correct BOOLEAN NOT NULL, FOREIGN KEY(question_id) REFERENCES questions(id) ON DELETE CASCADE)"
+        ]
+
+    for db_query in db_queries:
+        cursor.execute(db_query)
+
+
+def add_question_fingerprints(backend, cursor):
+
+    """ Migration 2: fingerprint column used by the synchroniser to skip known questions
+
+        Values for existing questions are filled in by the synchroniser the next time it runs
+    """
+
+    if not backend.column_exists(cursor, 'questions', 'question_hash'):
+        if backend.name == 'mysql':
+            cursor.execute("ALTER TABLE questions ADD COLUMN question_hash BINARY(16) UNIQUE")
+        else:
+            # SQLite can't add a UNIQUE column, so the uniqueness comes from an index
+            cursor.execute("ALTER TABLE questions ADD COLUMN question_hash BLOB")
+            cursor.execute("CREATE UNIQUE INDEX idx_questions_question_hash ON questions (question_hash)")
+
+
+def add_query_indexes(backend, cursor):
+
+    """ Migration 3: indexes for the level counts and the API's category/difficulty/type filters, and for fetching answers
+    """
+
+    if not backend.index_exists(cursor, 'questions', 'idx_questions_category_difficulty_type'):
+        cursor.execute("CREATE INDEX idx_questions_category_difficulty_type ON questions (category_id, difficulty, type)")
+
+    if not backend.index_exists(cursor, 'answers', 'idx_answers_question_correct'):
+        cursor.execute("CREATE INDEX idx_answers_question_correct ON answers (question_id, correct)")
+
+
+def add_sync_journal(backend, cursor):
+
+    """ Migration 4: per category/level sync progress so interrupted runs can resume
+    """
+
+    # SQLite has no ON UPDATE clause - updated_at records when the level was started
+    on_update = " ON UPDATE CURRENT_TIMESTAMP" if backend.name == 'mysql' else ""
+
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS sync_journal (category_id INTEGER NOT NULL, difficulty VARCHAR(16) NOT NULL, token VARCHAR(64) NOT NULL, target INTEGER NOT NULL, pages_fetched INTEGER NOT NULL DEFAULT 0, questions_fetched INTEGER NOT NULL DEFAULT 0, rows_committed INTEGER NOT NULL DEFAULT 0, completed BOOLEAN NOT NULL DEFAULT 0, updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP{on_update}, PRIMARY KEY (category_id, difficulty))")
+
+
+def add_category_leases(backend, cursor):
+
+    """ Migration 5: category leases so several workers can share a sync without fetching the same category
+    """
+
+    # Times are seconds since the epoch, as given by the workers' clocks
+    cursor.execute("CREATE TABLE IF NOT EXISTS category_leases (category_id INTEGER PRIMARY KEY NOT NULL, worker VARCHAR(128), expires_at DOUBLE, heartbeat_at DOUBLE)")
+
+
+def add_question_sequence(backend, cursor):
+
+    """ Migration 6: dense per category/difficulty/type positions so readers can pick random questions by position
+    """
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS question_sequence (category_id INTEGER NOT NULL, difficulty VARCHAR(16) NOT NULL, type VARCHAR(16) NOT NULL, position INTEGER NOT NULL, question_id INTEGER NOT NULL UNIQUE, PRIMARY KEY (category_id, difficulty, type, position), FOREIGN KEY(question_id) REFERENCES questions(id) ON DELETE CASCADE)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS sequence_buckets (category_id INTEGER NOT NULL, difficulty VARCHAR(16) NOT NULL, type VARCHAR(16) NOT NULL, size INTEGER NOT NULL, PRIMARY KEY (category_id, difficulty, type))")
+
+
+def add_change_feed(backend, cursor):
+
+    """ Migration 7: append-only feed of question changes for downstream caches
+    """
+
+    # Change ids are handed out from changefeed_head so they're assigned in commit order
+    cursor.execute("CREATE TABLE IF NOT EXISTS question_changes (change_id BIGINT PRIMARY KEY NOT NULL, question_id INTEGER NOT NULL, category_id INTEGER NOT NULL, difficulty VARCHAR(16) NOT NULL, change_type VARCHAR(16) NOT NULL, changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS changefeed_head (id INTEGER PRIMARY KEY NOT NULL, last_change_id BIGINT NOT NULL)")
+    cursor.execute(backend.insert_ignore_sql('changefeed_head', ['id', 'last_change_id']), (1, 0))
+
+
+def add_content_fingerprints(backend, cursor):
+
+    """ Migration 8: fingerprint of each question's text, answers, difficulty and type, so upstream corrections can be spotted
+
+        Values for existing questions are filled in by the synchroniser the next time it runs
+    """
+
+    if not backend.column_exists(cursor, 'questions', 'content_hash'):
+        column_type = "BINARY(16)" if backend.name == 'mysql' else "BLOB"
+        cursor.execute(f"ALTER TABLE questions ADD COLUMN content_hash {column_type}")
+
+
+def add_text_variants(backend, cursor):
+
+    """ Migration 9: store question and answer text decoded, with an HTML-escaped copy alongside
+
+        Text stored before this migration is HTML-encoded as the API returns it by default, so it is decoded here, along
+        with category names taken from the questions. Its fingerprints are cleared for the synchroniser to recalculate
+        from the decoded text the next time it runs.
+    """
+
+    if not backend.column_exists(cursor, 'questions', 'question_html'):
+        cursor.execute("ALTER TABLE questions ADD COLUMN question_html TEXT")
+
+    if not backend.column_exists(cursor, 'answers', 'answer_html'):
+        cursor.execute("ALTER TABLE answers ADD COLUMN answer_html TEXT")
+
+    # Names from the category list were never encoded, so only those from question pages change
+    cursor.execute("SELECT id, category FROM categories")
+    categories = [(html.unescape(category), category_id) for category_id, category in cursor.fetchall() if html.unescape(category) != category]
+
+    if categories:
+        cursor.executemany("UPDATE categories SET category = %s WHERE id = %s", categories)
+
+    cursor.execute("SELECT id, question_text FROM questions WHERE question_html IS NULL")
+    questions = [(html.unescape(question_text), question_id) for question_id, question_text in cursor.fetchall()]
+
+    if questions:
+        cursor.executemany("UPDATE questions SET question_text = %s, question_html = %s, question_hash = NULL, content_hash = NULL WHERE id = %s", [(question_text, escape_html(question_text), question_id) for question_text, question_id in questions])
+
+    cursor.execute("SELECT DISTINCT question_id, answer FROM answers WHERE answer IS NOT NULL AND answer_html IS NULL")
+    answers = cursor.fetchall()
+
+    if answers:
+        cursor.executemany("UPDATE answers SET answer = %s, answer_html = %s WHERE question_id = %s AND answer = %s", [(html.unescape(answer), escape_html(html.unescape(answer)), question_id, answer) for question_id, answer in answers])
+
+
+def add_question_documents(backend, cursor):
+
+    """ Migration 10: ready-to-serve JSON document for each question, so questions can be fetched by id without a join
+    """
+
+    for column in ['document', 'document_html']:
+        if not backend.column_exists(cursor, 'questions', column):
+            cursor.execute(f"ALTER TABLE questions ADD COLUMN {column} TEXT")
+
+    fill_documents(cursor)
+
+
+def add_database_identity(backend, cursor):
+
+    """ Migration 11: random identifier for the database, so a snapshot taken from another database is never built on
+    """
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS database_identity (id INTEGER PRIMARY KEY NOT NULL, identifier BINARY(16) NOT NULL)")
+    cursor.execute(backend.insert_ignore_sql('database_identity', ['id', 'identifier']), (1, uuid.uuid4().bytes))
+
+
+# Numbered schema migrations, applied in order. Each must be safe to re-run as MySQL commits DDL statements immediately.
+MIGRATIONS = [
+    (1, "Create tables", create_tables),
+    (2, "Add question fingerprints", add_question_fingerprints),
+    (3, "Add query indexes", add_query_indexes),
+    (4, "Add sync journal", add_sync_journal),
+    (5, "Add category leases", add_category_leases),
+    (6, "Add question sequence", add_question_sequence),
+    (7, "Add change feed", add_change_feed),
+    (8, "Add content fingerprints", add_content_fingerprints),
+    (9, "Add decoded and HTML-escaped text", add_text_variants),
+    (10, "Add question documents", add_question_documents),
+    (11, "Add database identity", add_database_identity)
+]
+
+
+def migrate(backend):
+
+    """ Bring the schema up to date, recording each migration applied
+
+        :param backend: Storage backend for the project database
+        :return: The schema version
+    """
+
+    with backend.connection() as connection:
+        with backend.cursor(connection) as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY NOT NULL, description VARCHAR(255) NOT NULL, applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)")
+            cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+            schema_version = cursor.fetchone()[0]
+
+            for version, description, migration in MIGRATIONS:
+                if version <= schema_version:
+                    continue
+
+                print(f"Applying migration {version}: {description}")
+                migration(backend, cursor)
+
+                cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)", (version, description))
+                connection.commit()
+                schema_version = version
+
+    return schema_version